@@ -1,32 +1,52 @@
 import streamlit as st
 import polars as pl
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import io
-import time
+from plotly.subplots import make_subplots
+import numpy as np
 import gc
+import math
 import os
 import shutil
+import uuid
 import warnings
+from motor import (
+    SESSIONS_DIR, PROJECTS_DIR, STATE_FILE, CUBE_FILE, EXPORT_DIR, EXPORT_FORMATS, EXCEL_MAX_ROWS, EXCEL_MAX_SHEETS, HLL_ERROR,
+    CONFIG_FILE, init_env, reset_workspace, link_workspace, load_config, read_header, load_sample_optimized, excel_sheets, new_run_id, ingest_files, update_aggregates,
+    calculate_stats_table, get_dashboard_metrics, metrics_cache, export_dataset, export_excel, measure, perf_log,
+    TABLE_PAGE_ROWS, label_index, search_labels, label_codes, stats_view, stats_page, series_for_range, heatmap_cells,
+)
 
 # ------------------------------------------------------------------------------
 # CONFIGURAÇÃO E OTIMIZAÇÃO
 # ------------------------------------------------------------------------------
 warnings.filterwarnings("ignore")
+CHART_TITLES = {"Dia": "Volume Diário", "Semana": "Volume Semanal", "Mês": "Volume Mensal"}
+WEEKDAYS = ["Dom", "Seg", "Ter", "Qua", "Qui", "Sex", "Sáb"]
+MONTHS = ["Jan", "Fev", "Mar", "Abr", "Mai", "Jun", "Jul", "Ago", "Set", "Out", "Nov", "Dez"]
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-TEMP_DIR = "temp_data"
-
-def init_env():
-    if not os.path.exists(TEMP_DIR): os.makedirs(TEMP_DIR)
+def session_workspace():
+    # Cada sessão grava em sessoes/<id>: dois analistas no mesmo servidor não se sobrescrevem
+    if 'workspace' not in st.session_state:
+        st.session_state.workspace = os.path.join(SESSIONS_DIR, uuid.uuid4().hex)
+    ws = st.session_state.workspace
+    os.makedirs(ws, exist_ok=True)
+    os.utime(ws)
+    return ws
 
 def clear_data():
-    if os.path.exists(TEMP_DIR): shutil.rmtree(TEMP_DIR)
-    os.makedirs(TEMP_DIR)
+    # Só apaga workspaces de sessão; projetos abertos da linha de comando continuam no disco
+    ws = st.session_state.get("workspace")
+    if ws and os.path.abspath(ws).startswith(os.path.abspath(SESSIONS_DIR)) and os.path.exists(ws): shutil.rmtree(ws)
+    if ws: perf_log.clear(ws)
     for key in list(st.session_state.keys()): del st.session_state[key]
     gc.collect()
 
+def read_export(path):
+    # Chamado pelo download_button só no clique: lê o arquivo inteiro e fecha o handle na hora
+    with open(path, "rb") as fh: return fh.read()
+
 # ==============================================================================
 # 1. SETUP & CSS
 # ==============================================================================
@@ -64,134 +84,67 @@ def setup_page():
         </style>
     """, unsafe_allow_html=True)
 
-# ==============================================================================
-# 2. MOTOR DE DADOS (DISK BASED)
-# ==============================================================================
-
-def read_file_chunk(file) -> pl.DataFrame:
-    if hasattr(file, 'seek'): file.seek(0)
-    try:
-        if file.name.endswith('.csv'): return pl.read_csv(file, ignore_errors=True, infer_schema_length=0)
-        else:
-            try: return pl.read_excel(file, engine="calamine")
-            except: 
-                file.seek(0)
-                return pl.from_pandas(pd.read_excel(file))
-    except: return pl.DataFrame()
-
-def load_sample_optimized(file) -> pl.DataFrame:
-    if hasattr(file, 'seek'): file.seek(0)
-    try:
-        if file.name.endswith('.csv'): return pl.read_csv(file, n_rows=100, ignore_errors=True)
-        else: 
-            try: return pl.read_excel(file, engine="calamine")
-            except: return pl.read_excel(file) 
-    except: return pl.DataFrame()
-
-def process_save_chunk(file, idx, mapping, split_dt, dt_source):
-    df_raw = read_file_chunk(file)
-    if df_raw.is_empty(): return False
-    
-    exprs = []
-    if split_dt and dt_source in df_raw.columns:
-        try:
-            tc = pl.col(dt_source).str.to_datetime(strict=False)
-            exprs.extend([tc.dt.date().alias("Data"), tc.dt.time().alias("Hora")])
-        except:
-            exprs.extend([pl.col(dt_source).cast(pl.Utf8).alias("Data"), pl.lit(None).alias("Hora")])
-    else:
-        for target in ["Data", "Hora"]:
-            src = mapping.get(target)
-            if src and src in df_raw.columns:
-                if target == "Data":
-                    try: exprs.append(pl.col(src).str.to_datetime(strict=False).dt.date().alias("Data"))
-                    except: exprs.append(pl.col(src).alias("Data"))
-                else:
-                    try: exprs.append(pl.col(src).str.to_time(strict=False).alias("Hora"))
-                    except: exprs.append(pl.col(src).alias("Hora"))
-            else:
-                exprs.append(pl.lit(None).alias(target))
-
-    target_cols = ["Depósito", "SKU", "Pedido", "Caixa", "Quantidade", "Rota/Destino"]
-    for target in target_cols:
-        src = mapping.get(target)
-        if src and src in df_raw.columns:
-            if target == "Quantidade":
-                exprs.append(pl.col(src).cast(pl.Utf8).str.replace(",", ".").cast(pl.Float64, strict=False).fill_null(0.0).cast(pl.Float32).alias(target))
-            else:
-                exprs.append(pl.col(src).cast(pl.Utf8, strict=False).fill_null("").alias(target))
-        else:
-            if target == "Quantidade": exprs.append(pl.lit(0.0, dtype=pl.Float32).alias(target))
-            else: exprs.append(pl.lit("", dtype=pl.Utf8).alias(target))
-
-    try:
-        df_clean = df_raw.select(exprs)
-        file_path = os.path.join(TEMP_DIR, f"chunk_{idx}.parquet")
-        df_clean.write_parquet(file_path)
-        del df_raw, df_clean
-        gc.collect()
-        return True
-    except: return False
-
-def calculate_stats_table(dim_sku_file, key_sku, desc_sku, dim_dep_file, key_dep, desc_dep):
-    try: lf = pl.scan_parquet(f"{TEMP_DIR}/*.parquet")
-    except: return None
-
-    daily_agg = lf.filter(pl.col("Data").is_not_null()).group_by(["Depósito", "SKU", "Data"]).agg(pl.col("Quantidade").sum().alias("Qtd_Dia")).collect()
-    
-    stats = daily_agg.group_by(["Depósito", "SKU"]).agg([
-        pl.col("Qtd_Dia").mean().alias("Média"),
-        pl.col("Qtd_Dia").max().alias("Máximo"),
-        pl.col("Qtd_Dia").std().fill_null(0).alias("Desvio"),
-        pl.col("Qtd_Dia").quantile(0.95).alias("Percentil 95%")
-    ])
-    
-    stats = stats.with_columns([
-        (pl.col("Média") + pl.col("Desvio")).alias("Média + 1 Desv"),
-        (pl.col("Média") + (pl.col("Desvio") * 2)).alias("Média + 2 Desv"),
-        (pl.col("Média") + (pl.col("Desvio") * 3)).alias("Média + 3 Desv"),
-    ])
-
-    if dim_sku_file:
-        d_sku = read_file_chunk(dim_sku_file).select([pl.col(key_sku).cast(pl.Utf8).alias("K"), pl.col(desc_sku).cast(pl.Utf8).alias("D")])
-        stats = stats.join(d_sku, left_on="SKU", right_on="K", how="left").rename({"D": "Descrição"})
-    else: stats = stats.with_columns(pl.lit("-").alias("Descrição"))
-
-    if dim_dep_file:
-        d_dep = read_file_chunk(dim_dep_file).select([pl.col(key_dep).cast(pl.Utf8).alias("K"), pl.col(desc_dep).cast(pl.Utf8).alias("D")])
-        stats = stats.join(d_dep, left_on="Depósito", right_on="K", how="left").rename({"D": "Nome Depósito"})
-    else: stats = stats.with_columns(pl.lit("-").alias("Nome Depósito"))
-
-    stats = stats.rename({"Depósito": "Código Depósito", "Nome Depósito": "Depósito", "SKU": "SKU", "Descrição": "Descrição"})
-    cols = ["Código Depósito", "Depósito", "SKU", "Descrição", "Média", "Máximo", "Desvio", "Média + 1 Desv", "Média + 2 Desv", "Média + 3 Desv", "Percentil 95%"]
-    for c in cols: 
-        if c not in stats.columns: stats = stats.with_columns(pl.lit("-").alias(c))
-    
-    return stats.select(cols)
-
-def get_dashboard_metrics(sel_skus, sel_deps, drill_sku=None, drill_dep=None):
-    lf = pl.scan_parquet(f"{TEMP_DIR}/*.parquet")
-    if sel_skus: lf = lf.filter(pl.col("SKU").cast(pl.Utf8).is_in(sel_skus))
-    if sel_deps: lf = lf.filter(pl.col("Depósito").cast(pl.Utf8).is_in(sel_deps))
-    if drill_sku and drill_dep: lf = lf.filter((pl.col("SKU") == drill_sku) & (pl.col("Depósito") == drill_dep))
-
-    kpis = lf.select([
-        pl.len().alias("lines"),
-        pl.col("Quantidade").sum().alias("vol"),
-        pl.col("Pedido").n_unique().alias("pick"),
-        pl.col("SKU").n_unique().alias("skus"),
-        pl.col("Depósito").n_unique().alias("deps"),
-        pl.col("Data").n_unique().alias("days")
-    ]).collect().row(0)
-
-    daily_agg = (lf.filter(pl.col("Data").is_not_null()).group_by("Data").agg(pl.col("Quantidade").sum()).sort("Data")).collect()
-    return kpis, daily_agg
-
 # ==============================================================================
 # 3. UI PRINCIPAL
 # ==============================================================================
+def cached_header(file):
+    # Colunas de cada upload lidas uma vez por sessão, não a cada rerun
+    cache = st.session_state.setdefault("_headers", {})
+    key = (getattr(file, 'file_id', None) or file.name, getattr(file, 'size', None))
+    if key not in cache: cache[key] = read_header(file)
+    return cache[key]
+
+def dimension_inputs(prefix=""):
+    ts, td = st.tabs(["📦 SKU", "🏢 Depósito"])
+    with ts:
+        f_sku = st.file_uploader("Dimensão SKU", type=["xlsx", "csv"], key=prefix + "fs")
+        k_sku, d_sku = None, None
+        if f_sku:
+            cols = cached_header(f_sku)
+            k_sku = st.selectbox("Chave Código:", cols, key=prefix + "ks")
+            d_sku = st.selectbox("Col. Descrição:", cols, key=prefix + "ds")
+    with td:
+        f_dep = st.file_uploader("Dimensão Depósito", type=["xlsx", "csv"], key=prefix + "fd")
+        k_dep, d_dep = None, None
+        if f_dep:
+            cols = cached_header(f_dep)
+            k_dep = st.selectbox("Chave Código:", cols, key=prefix + "kd")
+            d_dep = st.selectbox("Col. Descrição:", cols, key=prefix + "dd")
+    return f_sku, k_sku, d_sku, f_dep, k_dep, d_dep
+
+def session_memo(name, source, key, build):
+    # Resultado guardado na sessão enquanto a tabela de estatísticas (o mesmo objeto) e a chave não mudam
+    memo = st.session_state.get(name)
+    if memo is None or memo[0] is not source or memo[1] != key:
+        memo = (source, key, build())
+        st.session_state[name] = memo
+    return memo[2]
+
+def label_filter(col, title, kind, stats):
+    # Busca no índice ordenado: só as opções encontradas (e as já escolhidas) vão para o navegador
+    index = session_memo(f"_idx_{kind}", stats, None, lambda: label_index(stats, kind))
+    term = col.text_input(f"Buscar {title}", key=f"busca_{kind}", placeholder="Código ou descrição")
+    chosen = st.session_state.get(f"filtro_{kind}", [])
+    sel = col.multiselect(f"Filtrar {title}", list(dict.fromkeys([*chosen, *search_labels(index, term)])), key=f"filtro_{kind}")
+    return label_codes(index, sel) or None
+
+def performance_panel(ws):
+    # Etapas medidas pelo motor nesta sessão (mais recentes primeiro) e planos do polars das mais lentas
+    recs = perf_log.records(ws)
+    if not recs: return
+    with st.expander("⏱️ Performance"):
+        df = pl.DataFrame([{k: v for k, v in r.items() if k != "plano"} for r in reversed(recs)], infer_schema_length=None)
+        df = df.with_columns([(pl.col(c) / 1024**2).round(2).alias(c.replace("bytes_", "MB_")) for c in ["bytes_lidos", "bytes_gravados"]]).drop(["bytes_lidos", "bytes_gravados"])
+        first = ["etapa", "segundos", "linhas", "MB_lidos", "MB_gravados", "pico_rss_mb"]
+        st.dataframe(df.select([*first, pl.exclude(first)]), use_container_width=True, height=250, hide_index=True)
+        slow = sorted((r for r in recs if r.get("plano")), key=lambda r: r["segundos"], reverse=True)[:10]
+        if slow:
+            i = st.selectbox("Plano de consulta (etapas mais lentas)", range(len(slow)), format_func=lambda i: f"{slow[i]['segundos']:.2f}s · {slow[i]['etapa']} · {slow[i].get('arquivo') or slow[i]['inicio']}")
+            if st.toggle("Mostrar plano"): st.code(slow[i]["plano"], language=None)
+
 def main():
     setup_page()
+    ws = session_workspace()
 
     c_logo, c_title, c_act = st.columns([0.15, 0.65, 0.2], vertical_alignment="bottom")
     with c_logo:
@@ -209,6 +162,11 @@ def main():
         st.session_state.mapping = {}
         st.session_state.split_dt = True
         st.session_state.dt_source = None
+    # Aba parada além de SESSION_TTL_H: o init_env já apagou o workspace, então recomeça da ETAPA 1
+    if st.session_state.current_step >= 4 and not all(os.path.exists(os.path.join(ws, f)) for f in [CUBE_FILE, STATE_FILE]):
+        for key in ["final_stats", "selected_row", "export_filters", "export_analysis", "export_full"]: st.session_state.pop(key, None)
+        st.session_state.current_step = 1
+        st.warning("⚠️ Os dados desta sessão expiraram e foram removidos do servidor. Carregue os arquivos novamente (arquivos já processados vêm do cache).")
 
     # ETAPA 1
     if st.session_state.current_step > 1: st.markdown("""<div class="step-summary"><div class="step-check">✓</div><div class="step-text">Etapa 1: Configuração Concluída.</div></div>""", unsafe_allow_html=True)
@@ -216,10 +174,31 @@ def main():
         st.markdown("""<div class="step-header-card"><span class="step-badge">ETAPA 1</span><h3 class="step-title">Configuração Inicial</h3></div>""", unsafe_allow_html=True)
         f = st.file_uploader("Arquivo de Amostra", type=["xlsx", "csv"], label_visibility="collapsed")
         if f:
-            df_s = load_sample_optimized(f)
-            st.session_state.cols_origem = ["--- Ignorar ---"] + df_s.columns
-            st.session_state.current_step = 2
-            st.rerun()
+            # Excel com várias abas: o mapeamento é feito sobre a aba escolhida
+            sheets = excel_sheets(f) if f.name.endswith(".xlsx") else []
+            sheet = st.selectbox("Aba da amostra", sheets) if len(sheets) > 1 else None
+            if len(sheets) <= 1 or st.button("Continuar", type="primary"):
+                df_s = load_sample_optimized(f, sheet, ws)
+                st.session_state.cols_origem = ["--- Ignorar ---"] + df_s.columns
+                st.session_state.sample_sheet = sheet
+                st.session_state.current_step = 2
+                st.rerun()
+        projects = sorted(p for p in os.listdir(PROJECTS_DIR) if os.path.exists(os.path.join(PROJECTS_DIR, p, STATE_FILE)))
+        if projects:
+            with st.expander("📂 Abrir projeto pré-processado (linha de comando)"):
+                proj = st.selectbox("Projeto", projects)
+                if st.button("Abrir Projeto", type="primary"):
+                    # O projeto é compartilhado: a sessão trabalha numa cópia (hardlinks) no próprio workspace,
+                    # então acréscimos e dimensões atualizadas não mexem no projeto nem em outras sessões
+                    shutil.rmtree(ws, ignore_errors=True)
+                    link_workspace(os.path.join(PROJECTS_DIR, proj), ws)
+                    cfg_path = os.path.join(ws, CONFIG_FILE)
+                    if os.path.exists(cfg_path):
+                        cfg = load_config(cfg_path)
+                        st.session_state.mapping, st.session_state.split_dt, st.session_state.dt_source = cfg["mapping"], cfg["split_dt"], cfg["dt_source"]
+                    st.session_state.final_stats = calculate_stats_table(ws=ws)
+                    st.session_state.current_step = 4
+                    st.rerun()
 
     # ETAPA 2
     if st.session_state.current_step > 2: st.markdown("""<div class="step-summary"><div class="step-check">✓</div><div class="step-text">Etapa 2: Mapeamento Definido.</div></div>""", unsafe_allow_html=True)
@@ -249,42 +228,49 @@ def main():
 
     # ETAPA 3
     if st.session_state.current_step > 3: st.markdown("""<div class="step-summary"><div class="step-check">✓</div><div class="step-text">Etapa 3: Dados Processados.</div></div>""", unsafe_allow_html=True)
+    for name, msg in st.session_state.get("ingest_errors", []): st.warning(f"⚠️ {name}: {msg}")
     if st.session_state.current_step == 3:
         st.markdown("""<div class="step-header-card"><span class="step-badge">ETAPA 3</span><h3 class="step-title">Processamento em Lote</h3></div>""", unsafe_allow_html=True)
+        append_mode = st.session_state.get("append_mode", False) and os.path.exists(os.path.join(ws, STATE_FILE))
+        if append_mode:
+            st.info("➕ Modo acréscimo: apenas os novos arquivos serão processados e somados aos dados existentes.")
+            if st.button("Cancelar acréscimo", type="secondary"):
+                st.session_state.append_mode = False
+                st.session_state.current_step = 4
+                st.rerun()
         cm, cd = st.columns([1, 1])
         with cm:
             st.markdown("##### 1. Movimentação")
             files_mov = st.file_uploader("Arquivos", type=["xlsx", "csv"], accept_multiple_files=True)
+            sheets = None
+            if any(f.name.endswith(".xlsx") for f in files_mov or []):
+                sheet_opts = {"Primeira aba": None, "Todas as abas com as colunas mapeadas": "*"}
+                if st.session_state.get("sample_sheet"): sheet_opts = {f"Aba \"{st.session_state.sample_sheet}\"": [st.session_state.sample_sheet], **sheet_opts}
+                sheets = sheet_opts[st.radio("Abas do Excel", list(sheet_opts), horizontal=True)]
         with cd:
             st.markdown("##### 2. Dimensões")
-            ts, td = st.tabs(["📦 SKU", "🏢 Depósito"])
-            with ts:
-                f_sku = st.file_uploader("Dimensão SKU", type=["xlsx", "csv"])
-                k_sku, d_sku = None, None
-                if f_sku:
-                    cols = load_sample_optimized(f_sku).columns
-                    k_sku = st.selectbox("Chave Código:", cols, key="ks")
-                    d_sku = st.selectbox("Col. Descrição:", cols, key="ds")
-            with td:
-                f_dep = st.file_uploader("Dimensão Depósito", type=["xlsx", "csv"])
-                k_dep, d_dep = None, None
-                if f_dep:
-                    cols = load_sample_optimized(f_dep).columns
-                    k_dep = st.selectbox("Chave Código:", cols, key="kd")
-                    d_dep = st.selectbox("Col. Descrição:", cols, key="dd")
+            f_sku, k_sku, d_sku, f_dep, k_dep, d_dep = dimension_inputs()
         st.markdown("###")
         if files_mov and st.button("🚀 Processar", type="primary", use_container_width=True):
-            if os.path.exists(TEMP_DIR): shutil.rmtree(TEMP_DIR)
-            os.makedirs(TEMP_DIR)
+            if not append_mode:
+                reset_workspace(ws)
+            run_id = new_run_id()
             bar = st.progress(0, "Processando...")
-            for i, f in enumerate(files_mov):
-                process_save_chunk(f, i, st.session_state.mapping, st.session_state.split_dt, st.session_state.dt_source)
-                bar.progress((i+1)/len(files_mov))
-            
+            errors = ingest_files(
+                files_mov, st.session_state.mapping, st.session_state.split_dt, st.session_state.dt_source, run_id,
+                on_progress=lambda done, total, name: bar.progress(done / total, f"{done}/{total} arquivos · {name}"), ws=ws, sheets=sheets
+            )
+            st.session_state.ingest_errors = errors
+            if len(errors) == len(files_mov):
+                st.error("Nenhum arquivo pôde ser processado.")
+                st.stop()
+
             with st.status("Calculando estatísticas...", expanded=True):
-                stats = calculate_stats_table(f_sku, k_sku, d_sku, f_dep, k_dep, d_dep)
+                update_aggregates(run_id, ws)
+                stats = calculate_stats_table(f_sku, k_sku, d_sku, f_dep, k_dep, d_dep, ws)
                 if stats is not None:
                     st.session_state.final_stats = stats
+                    st.session_state.append_mode = False
                     st.session_state.current_step = 4
                     st.rerun()
                 else: st.error("Erro no cálculo.")
@@ -292,153 +278,208 @@ def main():
     # ETAPA 4 (DASHBOARD)
     if st.session_state.current_step > 4: st.markdown("""<div class="step-summary"><div class="step-check">✓</div><div class="step-text">Etapa 4: Análise Concluída.</div></div>""", unsafe_allow_html=True)
     if st.session_state.current_step == 4:
-        stats = st.session_state.final_stats
-        st.markdown("""<div class="step-header-card"><span class="step-badge">ETAPA 4</span><h3 class="step-title">Dashboard de Análise</h3></div>""", unsafe_allow_html=True)
-        
-        # Filtros
-        stats = stats.with_columns([
-            pl.concat_str([pl.col("SKU"), pl.lit(" - "), pl.col("Descrição")]).alias("Label_SKU"),
-            pl.concat_str([pl.col("Código Depósito"), pl.lit(" - "), pl.col("Depósito")]).alias("Label_Dep")
-        ])
-        c1, c2 = st.columns(2)
-        sel_skus = c1.multiselect("Filtrar SKUs", stats["Label_SKU"].unique().sort().to_list())
-        sel_deps = c2.multiselect("Filtrar Depósitos", stats["Label_Dep"].unique().sort().to_list())
-        
-        v_stats = stats
-        if sel_skus: v_stats = v_stats.filter(pl.col("Label_SKU").is_in(sel_skus))
-        if sel_deps: v_stats = v_stats.filter(pl.col("Label_Dep").is_in(sel_deps))
-
-        drill_sku, drill_dep = None, None
-        if 'selected_row' in st.session_state:
-            drill_sku, drill_dep = st.session_state.selected_row.split("|")
-
-        filter_sku_codes = [s.split(" - ")[0] for s in sel_skus] if sel_skus else None
-        filter_dep_codes = [d.split(" - ")[0] for d in sel_deps] if sel_deps else None
-
-        # Métricas
-        kpi_vals, daily_agg = get_dashboard_metrics(filter_sku_codes, filter_dep_codes, drill_sku, drill_dep)
-        lines, vol, picks, skus, deps, days = kpi_vals
-        avg_day = vol / days if days > 0 else 0
-        max_day = daily_agg["Quantidade"].max() if not daily_agg.is_empty() else 0
-
-        # Renderiza KPIs
-        def kpi_html(l, v, s, t): return f"""<div class="kpi-card" title="{t}"><div class="kpi-label">{l}</div><div class="kpi-value">{v}</div><div class="kpi-sub">{s}</div></div>"""
-        
-        k1, k2, k3, k4, k5 = st.columns(5)
-        k1.markdown(kpi_html("Linhas", f"{lines:,}".replace(",", "."), "Registros", "Total de linhas"), unsafe_allow_html=True)
-        k2.markdown(kpi_html("Volume", f"{vol:,.0f}".replace(",", "."), "Unidades", "Soma Quantidade"), unsafe_allow_html=True)
-        k3.markdown(kpi_html("Picking", f"{picks:,}".replace(",", "."), "Pedidos", "Pedidos Únicos"), unsafe_allow_html=True)
-        k4.markdown(kpi_html("SKUs", f"{skus:,}", "Produtos", "SKUs Distintos"), unsafe_allow_html=True)
-        k5.markdown(kpi_html("Dias", f"{days}", "Ativos", "Dias com movimento"), unsafe_allow_html=True)
+        with measure("rerun dashboard", ws) as rerun_rec:
+            stats = st.session_state.final_stats
+            st.markdown("""<div class="step-header-card"><span class="step-badge">ETAPA 4</span><h3 class="step-title">Dashboard de Análise</h3></div>""", unsafe_allow_html=True)
         
-        st.markdown("###")
-        kt1, kt2, kt3 = st.columns(3)
-        kt1.markdown(kpi_html("Depósitos", f"{deps}", "Locais", "Depósitos Distintos"), unsafe_allow_html=True)
-        kt2.markdown(kpi_html("Média Diária", f"{avg_day:,.0f}".replace(",", "."), "Unid/Dia", "Volume / Dias"), unsafe_allow_html=True)
-        kt3.markdown(kpi_html("Pico Máximo", f"{max_day:,.0f}".replace(",", "."), "Recorde", "Maior dia"), unsafe_allow_html=True)
-
-        if 'selected_row' in st.session_state:
-            st.info(f"🔎 Filtrando detalhes para: SKU {drill_sku} | Depósito {drill_dep}")
-            if st.button("❌ Limpar Seleção (Voltar ao Geral)", type="secondary"):
-                del st.session_state.selected_row
-                st.rerun()
-
-        # TABELA
-        st.markdown("---")
-        st.subheader("📋 Detalhamento por SKU (Drill-Down)")
-        st.markdown("Selecione uma linha na tabela abaixo para filtrar os gráficos.")
+            # Filtros
+            c1, c2 = st.columns(2)
+            filter_sku_codes = label_filter(c1, "SKUs", "SKU", stats)
+            filter_dep_codes = label_filter(c2, "Depósitos", "Depósito", stats)
+
+            drill_sku, drill_dep = None, None
+            if 'selected_row' in st.session_state:
+                drill_sku, drill_dep = st.session_state.selected_row.split("|")
+
+            st.session_state.export_filters = (filter_sku_codes, filter_dep_codes, drill_sku, drill_dep)
+
+            # Métricas
+            exact_pick = st.toggle("Contagem exata de pedidos", value=False, help="Desligado: Picking é estimado por sketches HyperLogLog (rápido). Ligado: conta os pedidos nos dados brutos.")
+            kpi_vals, series = get_dashboard_metrics(filter_sku_codes, filter_dep_codes, drill_sku, drill_dep, exact_pick, ws)
+            lines, vol, picks, skus, deps, days = kpi_vals
+            avg_day = vol / days if days > 0 else 0
+            max_day = series["Dia"]["Quantidade"].max() if not series["Dia"].is_empty() else 0
+
+            # Renderiza KPIs
+            def kpi_html(l, v, s, t): return f"""<div class="kpi-card" title="{t}"><div class="kpi-label">{l}</div><div class="kpi-value">{v}</div><div class="kpi-sub">{s}</div></div>"""
         
-        pdf_tbl = v_stats.drop(["Label_SKU", "Label_Dep"]).to_pandas()
-        sel = st.dataframe(
-            pdf_tbl, 
-            use_container_width=True, 
-            height=350, 
-            on_select="rerun", 
-            selection_mode="single-row", 
-            column_config={
-                "Média": st.column_config.NumberColumn(format="%.2f"),
-                "Desvio": st.column_config.NumberColumn(format="%.2f"),
-                "Percentil 95%": st.column_config.NumberColumn(format="%.2f"),
-            }
-        )
+            k1, k2, k3, k4, k5 = st.columns(5)
+            k1.markdown(kpi_html("Linhas", f"{lines:,}".replace(",", "."), "Registros", "Total de linhas"), unsafe_allow_html=True)
+            k2.markdown(kpi_html("Volume", f"{vol:,.0f}".replace(",", "."), "Unidades", "Soma Quantidade"), unsafe_allow_html=True)
+            pick_tip = "Pedidos Únicos" if exact_pick else f"Pedidos Únicos (estimativa HyperLogLog, erro padrão ±{HLL_ERROR:.1%})".replace(".", ",")
+            k3.markdown(kpi_html("Picking", f"{picks:,}".replace(",", "."), "Pedidos" if exact_pick else "Pedidos (aprox.)", pick_tip), unsafe_allow_html=True)
+            k4.markdown(kpi_html("SKUs", f"{skus:,}", "Produtos", "SKUs Distintos"), unsafe_allow_html=True)
+            k5.markdown(kpi_html("Dias", f"{days}", "Ativos", "Dias com movimento"), unsafe_allow_html=True)
         
-        if sel.selection.rows:
-            row = pdf_tbl.iloc[sel.selection.rows[0]]
-            new_sel = f"{row['SKU']}|{row['Código Depósito']}"
-            if 'selected_row' not in st.session_state or st.session_state.selected_row != new_sel:
-                st.session_state.selected_row = new_sel
-                st.rerun()
+            st.markdown("###")
+            kt1, kt2, kt3 = st.columns(3)
+            kt1.markdown(kpi_html("Depósitos", f"{deps}", "Locais", "Depósitos Distintos"), unsafe_allow_html=True)
+            kt2.markdown(kpi_html("Média Diária", f"{avg_day:,.0f}".replace(",", "."), "Unid/Dia", "Volume / Dias"), unsafe_allow_html=True)
+            kt3.markdown(kpi_html("Pico Máximo", f"{max_day:,.0f}".replace(",", "."), "Recorde", "Maior dia"), unsafe_allow_html=True)
+            cs = metrics_cache.stats()
+            st.caption(f"Cache de consultas: {cs['hits']} acertos · {cs['misses']} falhas · {cs['entries']} entradas ({cs['bytes'] / 1024**2:.1f} MB)")
+
+            if 'selected_row' in st.session_state:
+                st.info(f"🔎 Filtrando detalhes para: SKU {drill_sku} | Depósito {drill_dep}")
+                if st.button("❌ Limpar Seleção (Voltar ao Geral)", type="secondary"):
+                    del st.session_state.selected_row
+                    st.rerun()
 
-        # GRÁFICOS
-        if not daily_agg.is_empty():
+            # TABELA
             st.markdown("---")
-            st.subheader("📊 Evolução e Sazonalidade")
-            pdf = daily_agg.to_pandas()
-            
-            # Gráfico de Barras
-            fig = px.bar(pdf, x="Data", y="Quantidade", template="plotly_white")
-            fig.update_layout(
-                paper_bgcolor='rgba(0,0,0,0)', 
-                plot_bgcolor='rgba(0,0,0,0)', 
-                font_color="#334155",
-                title_text="Volume Diário",
-                xaxis=dict(showgrid=False, title=None),
-                yaxis=dict(showgrid=True, gridcolor="#f1f5f9", title=None),
-                hovermode="x unified"
-            )
-            fig.update_traces(marker_color="#2563eb")
-            st.plotly_chart(fig, use_container_width=True)
-            
-            # Heatmap
-            pdf["Data"] = pd.to_datetime(pdf["Data"])
-            min_d = pdf["Data"].min()
-            dates = pd.date_range(start=min_d, periods=54*7, freq='D')
-            skel = pd.DataFrame({"Data": dates})
-            hm = pd.merge(skel, pdf, on="Data", how="left").fillna(0)
-            hm["W"] = hm["Data"].dt.strftime("%Y-W%U")
-            hm["D"] = hm["Data"].dt.strftime("%a")
-            
-            custom_colors = [[0.0, "#f1f5f9"], [0.2, "#cbd5e1"], [0.4, "#94a3b8"], [0.6, "#2dd4bf"], [0.8, "#0d9488"], [1.0, "#0f766e"]]
-
-            fig_hm = px.density_heatmap(
-                hm, x="W", y="D", z="Quantidade", 
-                title="Intensidade Semanal (Heatmap)", 
-                template="plotly_white",
-                color_continuous_scale=custom_colors,
-                category_orders={"D": ["Sun", "Sat", "Fri", "Thu", "Wed", "Tue", "Mon"]}
-            )
-            
-            fig_hm.update_layout(
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)',
-                font_color="#334155",
-                margin=dict(l=40, r=40, t=60, b=40),
-                xaxis=dict(showgrid=False, title=None, showticklabels=True),
-                yaxis=dict(showgrid=False, title=None),
-                coloraxis_colorbar=dict(title="Vol", thickness=15, len=0.7)
+            st.subheader("📋 Detalhamento por SKU (Drill-Down)")
+            st.markdown("Selecione uma linha na tabela abaixo para filtrar os gráficos.")
+        
+            # Busca, ordenação e paginação no servidor: só a página visível vira pandas
+            t1, t2, t3, t4 = st.columns([2, 1.2, 0.8, 0.8], vertical_alignment="bottom")
+            search = t1.text_input("Buscar na tabela", key="tbl_busca", placeholder="SKU, descrição ou depósito")
+            sort_by = t2.selectbox("Ordenar por", [None, *stats.columns], format_func=lambda c: c or "Ordem original", key="tbl_ordem")
+            descending = t3.toggle("Decrescente", value=True, key="tbl_desc")
+            view_key = (filter_sku_codes, filter_dep_codes, search, sort_by, descending)
+            view = session_memo("_tbl_view", stats, view_key, lambda: stats_view(stats, *view_key))
+            pages = max(1, math.ceil(view.len() / TABLE_PAGE_ROWS))
+            if st.session_state.get("tbl_pagina", 1) > pages: st.session_state.tbl_pagina = pages
+            page = t4.number_input("Página", min_value=1, max_value=pages, step=1, key="tbl_pagina")
+            pdf_tbl = stats_page(stats, view, page - 1).to_pandas()
+            rerun_rec["linhas"] = view.len()
+            st.caption(f"{view.len():,} linhas · página {page} de {pages:,}".replace(",", "."))
+            sel = st.dataframe(
+                pdf_tbl, 
+                use_container_width=True, 
+                height=350, 
+                on_select="rerun", 
+                selection_mode="single-row", 
+                column_config={
+                    "Média": st.column_config.NumberColumn(format="%.2f"),
+                    "Desvio": st.column_config.NumberColumn(format="%.2f"),
+                    "Percentil 95%": st.column_config.NumberColumn(format="%.2f"),
+                }
             )
-            fig_hm.update_traces(xgap=4, ygap=4, hovertemplate="Semana: %{x}<br>Dia: %{y}<br>Vol: %{z}<extra></extra>")
-            
-            st.plotly_chart(fig_hm, use_container_width=True)
+        
+            if sel.selection.rows:
+                row = pdf_tbl.iloc[sel.selection.rows[0]]
+                new_sel = f"{row['SKU']}|{row['Código Depósito']}"
+                if 'selected_row' not in st.session_state or st.session_state.selected_row != new_sel:
+                    st.session_state.selected_row = new_sel
+                    st.rerun()
 
-        st.markdown("###")
-        if st.button("Ir para Exportação", type="primary", use_container_width=True):
-            st.session_state.current_step = 5
-            st.rerun()
+            # GRÁFICOS
+            with measure("gráficos", ws) as chart_rec:
+                day = series["Dia"]
+                if not day.is_empty():
+                    st.markdown("---")
+                    st.subheader("📊 Evolução e Sazonalidade")
+                    d0, d1 = day["Data"].min(), day["Data"].max()
+                    # A chave muda com o período disponível: trocar filtros não deixa o slider fora do intervalo
+                    start, end = st.slider("Período", min_value=d0, max_value=d1, value=(d0, d1), format="DD/MM/YYYY", key=f"periodo_{d0}_{d1}") if d1 > d0 else (d0, d1)
+
+                    # Gráfico de Barras (dia, semana ou mês conforme o período)
+                    gran, pts = series_for_range(series, start, end)
+                    fig = px.bar(x=pts["Data"].to_list(), y=pts["Quantidade"].to_list(), template="plotly_white")
+                    fig.update_layout(
+                        paper_bgcolor='rgba(0,0,0,0)', 
+                        plot_bgcolor='rgba(0,0,0,0)', 
+                        font_color="#334155",
+                        title_text=CHART_TITLES[gran],
+                        xaxis=dict(showgrid=False, title=None),
+                        yaxis=dict(showgrid=True, gridcolor="#f1f5f9", title=None),
+                        hovermode="x unified"
+                    )
+                    fig.update_traces(marker_color="#2563eb", hovertemplate="%{y:,.0f}<extra></extra>")
+                    st.plotly_chart(fig, use_container_width=True)
+
+                    # Heatmap: semana x dia, um ano por linha; períodos longos viram ano x mês
+                    mode, cells = heatmap_cells(day, start, end)
+                    chart_rec["linhas"] = pts.height + cells.height
+                    custom_colors = [[0.0, "#f1f5f9"], [0.2, "#cbd5e1"], [0.4, "#94a3b8"], [0.6, "#2dd4bf"], [0.8, "#0d9488"], [1.0, "#0f766e"]]
+                    if mode == "Dia":
+                        years = cells["Ano"].unique().sort().to_list()
+                        fig_hm = make_subplots(rows=len(years), cols=1, subplot_titles=[str(y) for y in years], vertical_spacing=0.25 / len(years))
+                        for r, year in enumerate(years, 1):
+                            g = cells.filter(pl.col("Ano") == year)
+                            z = np.full((7, 54), np.nan)
+                            z[g["Dia_Semana"].to_numpy(), g["Semana_Ano"].to_numpy()] = g["Quantidade"].to_numpy()
+                            dates = np.full((7, 54), "", dtype=object)
+                            dates[g["Dia_Semana"].to_numpy(), g["Semana_Ano"].to_numpy()] = g["Data"].dt.strftime("%d/%m/%Y").to_numpy()
+                            fig_hm.add_trace(go.Heatmap(z=z, y=WEEKDAYS, customdata=dates, coloraxis="coloraxis", xgap=3, ygap=3,
+                                                        hovertemplate="%{customdata}<br>Vol: %{z:,.0f}<extra></extra>"), row=r, col=1)
+                            fig_hm.update_yaxes(autorange="reversed", row=r, col=1)
+                        fig_hm.update_xaxes(showticklabels=False)
+                        height = 80 + 170 * len(years)
+                    else:
+                        z = cells.pivot(on="Mês", index="Ano", values="Quantidade", sort_columns=True).sort("Ano")
+                        fig_hm = go.Figure(go.Heatmap(z=z.drop("Ano").to_numpy(), x=[MONTHS[int(m) - 1] for m in z.columns[1:]], y=[str(y) for y in z["Ano"]],
+                                                      coloraxis="coloraxis", xgap=3, ygap=3, hovertemplate="%{x}/%{y}<br>Vol: %{z:,.0f}<extra></extra>"))
+                        fig_hm.update_yaxes(autorange="reversed")
+                        height = 120 + 30 * z.height
+                    fig_hm.update_layout(
+                        title_text="Intensidade Semanal (Heatmap)" if mode == "Dia" else "Intensidade Mensal (Heatmap)",
+                        template="plotly_white",
+                        paper_bgcolor='rgba(0,0,0,0)',
+                        plot_bgcolor='rgba(0,0,0,0)',
+                        font_color="#334155",
+                        height=height,
+                        margin=dict(l=40, r=40, t=60, b=40),
+                        coloraxis=dict(colorscale=custom_colors, colorbar=dict(title="Vol", thickness=15, len=0.7))
+                    )
+                    st.plotly_chart(fig_hm, use_container_width=True)
+
+            st.markdown("###")
+            with st.expander("🗂️ Atualizar Dimensões (sem reprocessar movimentações)"):
+                u_sku, uk_sku, ud_sku, u_dep, uk_dep, ud_dep = dimension_inputs(prefix="upd_")
+                if (u_sku or u_dep) and st.button("Aplicar Dimensões", type="primary"):
+                    stats = calculate_stats_table(u_sku, uk_sku, ud_sku, u_dep, uk_dep, ud_dep, ws)
+                    if stats is not None:
+                        st.session_state.final_stats = stats
+                        st.rerun()
+
+            ca, ce = st.columns([1, 2])
+            if ca.button("➕ Adicionar Arquivos", type="secondary", use_container_width=True):
+                st.session_state.append_mode = True
+                st.session_state.current_step = 3
+                st.rerun()
+            if ce.button("Ir para Exportação", type="primary", use_container_width=True):
+                st.session_state.current_step = 5
+                st.rerun()
 
     # ETAPA 5
     if st.session_state.current_step == 5:
         st.markdown("""<div class="step-header-card"><span class="step-badge">ETAPA 5</span><h3 class="step-title">Downloads</h3></div>""", unsafe_allow_html=True)
-        b = io.BytesIO()
-        st.session_state.final_stats.write_excel(b)
-        st.download_button("Baixar Análise (.xlsx)", b.getvalue(), "analise.xlsx", use_container_width=True)
-        if st.button("Gerar CSV Completo", use_container_width=True):
-            lf = pl.scan_parquet(f"{TEMP_DIR}/*.parquet")
-            st.download_button("📥 Baixar CSV", lf.collect().write_csv(), "completo.csv", "text/csv")
+        # Arquivos gerados em disco; o download é adiado: os bytes só são lidos (e vão para a memória do servidor) quando o usuário clica
+        exp_dir = os.path.join(ws, EXPORT_DIR)
+        os.makedirs(exp_dir, exist_ok=True)
+        c_an, c_full = st.columns(2)
+        with c_an:
+            st.markdown("##### Análise Estatística")
+            if st.button("Gerar Análise (.xlsx)", use_container_width=True):
+                with st.spinner("Gerando planilha..."):
+                    path = os.path.join(exp_dir, "analise.xlsx")
+                    if export_excel(st.session_state.final_stats, path): st.session_state.export_analysis = path
+                    else:
+                        path = os.path.join(exp_dir, "analise.csv.gz")
+                        st.session_state.final_stats.lazy().sink_csv(path, compression="gzip", check_extension=False)
+                        st.session_state.export_analysis = path
+                        st.warning(f"A análise passa de {EXCEL_MAX_SHEETS} abas de {EXCEL_MAX_ROWS:,} linhas; gerado CSV (gzip) no lugar do Excel.".replace(",", "."))
+            path = st.session_state.get("export_analysis")
+            if path and os.path.exists(path):
+                st.download_button(f"📥 Baixar {os.path.basename(path)}", lambda p=path: read_export(p), os.path.basename(path), use_container_width=True)
+        with c_full:
+            st.markdown("##### Dados Completos")
+            fmt = st.selectbox("Formato", list(EXPORT_FORMATS), index=1)
+            use_filters = st.checkbox("Aplicar filtros do dashboard", value=False)
+            if st.button("Gerar Arquivo Completo", use_container_width=True):
+                filters = st.session_state.get("export_filters", (None, None, None, None)) if use_filters else (None, None, None, None)
+                with st.spinner("Exportando..."):
+                    st.session_state.export_full = export_dataset(os.path.join(exp_dir, "completo" + EXPORT_FORMATS[fmt][0]), fmt, *filters, ws=ws)
+            path = st.session_state.get("export_full")
+            if path and os.path.exists(path):
+                st.download_button(f"📥 Baixar {os.path.basename(path)}", lambda p=path: read_export(p), os.path.basename(path), use_container_width=True)
         st.markdown("---")
         if st.button("⬅️ Voltar"):
             st.session_state.current_step = 4
             st.rerun()
 
+    performance_panel(ws)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
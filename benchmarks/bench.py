@@ -0,0 +1,128 @@
+# Benchmarks do motor: tempo e pico de memória (RSS) por etapa, gravados em JSON para comparar execuções.
+#   python benchmarks/bench.py --linhas 1000000,10000000,50000000
+#   python benchmarks/bench.py --comparar benchmarks/resultados/antes.json benchmarks/resultados/depois.json
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import polars as pl
+import motor
+from gerador import COLUNAS, DT_SOURCE, gerar_csv, gerar_xlsx
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+@contextmanager
+def medir(resultados, linhas, etapa, intervalo=0.01):
+    # Amostra o RSS numa thread enquanto a etapa roda; o pico é o maior valor visto
+    base = motor.rss_bytes()
+    pico = [base or 0]
+    fim = threading.Event()
+    def amostrar():
+        while not fim.wait(intervalo): pico[0] = max(pico[0], motor.rss_bytes() or 0)
+    t = threading.Thread(target=amostrar, daemon=True)
+    t.start()
+    t0 = time.perf_counter()
+    try: yield
+    finally:
+        dt = time.perf_counter() - t0
+        fim.set(); t.join()
+        pico[0] = max(pico[0], motor.rss_bytes() or 0)
+        r = {"linhas": linhas, "etapa": etapa, "segundos": round(dt, 4), "linhas_por_s": round(linhas / dt) if dt else None,
+             "pico_rss_mb": round(pico[0] / 1024**2, 1) if base else None, "delta_rss_mb": round((pico[0] - base) / 1024**2, 1) if base else None}
+        resultados.append(r)
+        print(f"{linhas:>12,} {etapa:<34} {dt:9.3f}s  pico {r['pico_rss_mb']} MB (+{r['delta_rss_mb']})", flush=True)
+
+def arquivos(data_dir, linhas, formato):
+    # Reaproveita os arquivos gerados numa execução anterior com o mesmo tamanho
+    path = os.path.join(data_dir, f"mov_{linhas}.{formato}")
+    if formato == "csv":
+        return [path] if os.path.exists(path) else gerar_csv(path, linhas)
+    existentes = sorted(p for p in os.listdir(data_dir) if re.fullmatch(rf"mov_{linhas}(_\d+)?\.xlsx", p)) if os.path.isdir(data_dir) else []
+    return [os.path.join(data_dir, p) for p in existentes] or gerar_xlsx(path, linhas)
+
+def rodar(linhas, formato, data_dir, work_dir, res):
+    files = arquivos(data_dir, linhas, formato)
+    ws = os.path.join(work_dir, f"ws_{linhas}")
+    motor.CACHE_DIR = os.path.join(work_dir, "cache")
+    for d in (ws, motor.CACHE_DIR): shutil.rmtree(d, ignore_errors=True)
+    os.makedirs(ws)
+
+    def ingerir():
+        with ExitStack() as stack:
+            handles = [stack.enter_context(open(f, "rb")) for f in files]
+            erros = motor.ingest_files(handles, COLUNAS, True, DT_SOURCE, run_id, ws=ws)
+        if erros: raise RuntimeError(erros)
+
+    run_id = motor.new_run_id()
+    with medir(res, linhas, "process_save_chunk"): ingerir()
+    with medir(res, linhas, "update_aggregates"): motor.update_aggregates(run_id, ws)
+    with medir(res, linhas, "calculate_stats_table"): stats = motor.calculate_stats_table(ws=ws)
+
+    # Filtros típicos: geral, maior depósito, 10 SKUs mais frequentes, drill-down num par
+    top = stats.sort("Média", descending=True)
+    dep, sku = top["Código Depósito"][0], top["SKU"][0]
+    filtros = {
+        "geral": (None, None), "1_deposito": (None, [dep]),
+        "10_skus": (top["SKU"].unique(maintain_order=True).head(10).to_list(), None), "drill": (None, None, sku, dep),
+    }
+    for nome, f in filtros.items():
+        with medir(res, linhas, f"get_dashboard_metrics[{nome}]"): motor.compute_dashboard_metrics(*f, ws=ws)
+    with medir(res, linhas, "get_dashboard_metrics[exato]"): motor.compute_dashboard_metrics(None, None, exact_pick=True, ws=ws)
+
+    out = os.path.join(work_dir, "export")
+    os.makedirs(out, exist_ok=True)
+    with medir(res, linhas, "export[CSV (gzip)]"): motor.export_dataset(os.path.join(out, "c.csv.gz"), "CSV (gzip)", ws=ws)
+    with medir(res, linhas, "export[Parquet]"): motor.export_dataset(os.path.join(out, "c.parquet"), "Parquet", ws=ws)
+
+    # Segunda ingestão do mesmo arquivo: mede o acerto do cache por conteúdo
+    shutil.rmtree(os.path.join(ws, motor.STORE_DIR))
+    run_id = motor.new_run_id()
+    with medir(res, linhas, "process_save_chunk[cache]"): ingerir()
+    shutil.rmtree(ws, ignore_errors=True)
+
+def meta():
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=BASE_DIR).stdout.strip()
+    except OSError: commit = None
+    return {"data": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "polars": pl.__version__, "python": platform.python_version(),
+            "cpus": os.cpu_count(), "batch_rows": motor.BATCH_ROWS, "max_workers": motor.MAX_WORKERS}
+
+def comparar(a, b):
+    with open(a) as fa, open(b) as fb: ra, rb = json.load(fa), json.load(fb)
+    antes = {(r["linhas"], r["etapa"]): r for r in ra["resultados"]}
+    print(f"{'linhas':>12} {'etapa':<34} {'antes':>9} {'depois':>9} {'Δ tempo':>8} {'Δ pico MB':>10}")
+    for r in rb["resultados"]:
+        o = antes.get((r["linhas"], r["etapa"]))
+        if not o: continue
+        dt = (r["segundos"] / o["segundos"] - 1) if o["segundos"] else 0
+        dm = (r["pico_rss_mb"] or 0) - (o["pico_rss_mb"] or 0)
+        print(f"{r['linhas']:>12,} {r['etapa']:<34} {o['segundos']:9.3f} {r['segundos']:9.3f} {dt:+8.1%} {dm:+10.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mede ingestão, estatísticas, dashboard e exportação.")
+    parser.add_argument("--linhas", default="1000000,10000000,50000000", help="tamanhos separados por vírgula")
+    parser.add_argument("--formato", choices=["csv", "xlsx"], default="csv")
+    parser.add_argument("--dados", default=os.path.join(BASE_DIR, "dados"), help="onde guardar os arquivos gerados")
+    parser.add_argument("--trabalho", default=os.path.join(BASE_DIR, "trabalho"), help="workspace temporário")
+    parser.add_argument("--saida", help="arquivo JSON (padrão: benchmarks/resultados/<data>.json)")
+    parser.add_argument("--comparar", nargs=2, metavar=("ANTES", "DEPOIS"))
+    args = parser.parse_args(argv)
+    if args.comparar: return comparar(*args.comparar)
+
+    res = []
+    for n in (int(x) for x in args.linhas.split(",")): rodar(n, args.formato, args.dados, args.trabalho, res)
+    saida = args.saida or os.path.join(BASE_DIR, "resultados", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(saida), exist_ok=True)
+    with open(saida, "w") as fh: json.dump({"meta": {**meta(), "formato": args.formato}, "resultados": res}, fh, indent=2, ensure_ascii=False)
+    print(saida)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Gerador de movimentações sintéticas para os benchmarks.
+# Reproduz o formato dos extratos de WMS: popularidade de SKU concentrada (Zipf), muitos depósitos,
+# vários anos de datas, Data/Hora numa coluna só e Quantidade com vírgula decimal.
+#   python benchmarks/gerador.py --linhas 1000000 --saida bench_data/mov.csv
+import argparse
+import os
+import numpy as np
+import polars as pl
+
+COLUNAS = {"Depósito": "Deposito", "SKU": "Cod Produto", "Pedido": "Pedido", "Caixa": "Caixa", "Quantidade": "Qtd", "Rota/Destino": "Rota"}
+DT_SOURCE = "Data Hora"
+XLSX_MAX_LINHAS = 1_000_000  # abaixo do limite de 1.048.576 linhas por aba
+LOTE = 1_000_000
+
+def gerar_lote(rng, n, inicio, skus=200_000, depositos=80, anos=3, zipf=1.3):
+    sku = (rng.zipf(zipf, n) - 1) % skus
+    dep = (rng.zipf(1.6, n) - 1) % depositos
+    seg = rng.integers(0, anos * 365 * 86_400, n)
+    qtd = np.round(rng.gamma(1.5, 4.0, n), 1)
+    return pl.DataFrame({
+        "Deposito": dep, "Cod Produto": sku, "Pedido": inicio // 4 + np.arange(n) // 4, "Caixa": rng.integers(1, 40, n),
+        "Qtd": qtd, "Data Hora": seg, "Rota": rng.integers(1, 500, n),
+    }).select([
+        pl.format("DEP{}", pl.col("Deposito")).alias("Deposito"),
+        pl.col("Cod Produto").cast(pl.Utf8).str.zfill(7).alias("Cod Produto"),
+        pl.format("PED{}", pl.col("Pedido")).alias("Pedido"),
+        pl.col("Caixa").cast(pl.Utf8),
+        pl.col("Qtd").cast(pl.Utf8).str.replace(".", ",", literal=True).alias("Qtd"),
+        (pl.datetime(2022, 1, 1) + pl.duration(seconds=pl.col("Data Hora"))).dt.strftime("%Y-%m-%d %H:%M:%S").alias("Data Hora"),
+        pl.format("R{}", pl.col("Rota")).alias("Rota"),
+    ])
+
+def gerar_csv(path, linhas, seed=42, **kw):
+    # Escreve em lotes para que 50M de linhas não precisem caber em memória
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as fh:
+        for i, ini in enumerate(range(0, linhas, LOTE)):
+            gerar_lote(rng, min(LOTE, linhas - ini), ini, **kw).write_csv(fh, include_header=i == 0)
+    return [path]
+
+def gerar_xlsx(path, linhas, seed=42, **kw):
+    # Um arquivo por XLSX_MAX_LINHAS, como fazem os extratos reais quando passam do limite da aba
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    base, _ = os.path.splitext(path)
+    paths = []
+    for i, ini in enumerate(range(0, linhas, XLSX_MAX_LINHAS)):
+        p = f"{base}_{i}.xlsx" if linhas > XLSX_MAX_LINHAS else path
+        gerar_lote(rng, min(XLSX_MAX_LINHAS, linhas - ini), ini, **kw).write_excel(p)
+        paths.append(p)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera arquivos sintéticos de movimentação.")
+    parser.add_argument("--linhas", type=int, default=1_000_000)
+    parser.add_argument("--saida", default="bench_data/mov.csv", help="caminho .csv ou .xlsx")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    gerar = gerar_xlsx if args.saida.endswith(".xlsx") else gerar_csv
+    for p in gerar(args.saida, args.linhas, args.seed): print(p)
+
+if __name__ == "__main__":
+    main()
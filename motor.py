@@ -0,0 +1,1108 @@
+# Motor de dados (ETL, agregados, consultas e exportação) sem dependência de UI.
+# Usado pelo app Streamlit e pela linha de comando (ver main() no fim do arquivo):
+#   python motor.py --config mapeamento.json --entrada pasta/ --workspace temp_data/projetos/mensal
+import polars as pl
+import argparse
+import glob
+import sys
+import time
+import gc
+import math
+import re
+import json
+import logging
+import hashlib
+import threading
+import uuid
+import os
+import shutil
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from contextlib import ExitStack, contextmanager
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# ------------------------------------------------------------------------------
+# CONFIGURAÇÃO E OTIMIZAÇÃO
+# ------------------------------------------------------------------------------
+TEMP_DIR = "temp_data"
+BATCH_ROWS = int(os.environ.get("DS_BATCH_ROWS", 1_000_000))  # linhas por lote/parte Parquet na ingestão
+SESSIONS_DIR = os.path.join(TEMP_DIR, "sessoes")  # um workspace por sessão do Streamlit
+PROJECTS_DIR = os.path.join(TEMP_DIR, "projetos")  # workspaces gerados pela linha de comando
+SESSION_TTL_H = 24  # workspaces sem uso há mais tempo que isso são removidos
+CACHE_DIR = os.path.join(TEMP_DIR, "cache")  # saídas Parquet por conteúdo do arquivo + mapeamento
+CACHE_MAX_BYTES = int(float(os.environ.get("DS_CACHE_MAX_GB", 20)) * 1024**3)
+CACHE_META = "meta.json"
+CACHE_VERSION = 2  # incrementar quando o formato gravado por process_save_chunk mudar
+STORE_DIR = "movimentos"  # dataset particionado Depósito=/AnoMes= (relativo ao workspace)
+PARTITION_COLS = ["Depósito", "AnoMes"]
+STORE_COLS = ["Data", "Hora", "Depósito", "SKU", "Pedido", "Caixa", "Quantidade", "Rota/Destino"]
+CUBE_FILE = "cubo_diario.parquet"
+CALENDAR_FILE = "calendario.parquet"  # dimensão de datas do período carregado (chaves de semana e mês)
+GRANULARITIES = ["Dia", "Semana", "Mês"]
+CHART_MAX_POINTS = 370  # barras por gráfico: acima disso a série passa para semana e depois para mês
+HEATMAP_MAX_YEARS = 3  # até isso o heatmap é semana x dia (um ano por linha); acima, ano x mês
+KEY_DIMS = {"Depósito": ("Dep_ID", "chaves_deposito.parquet"), "SKU": ("SKU_ID", "chaves_sku.parquet")}  # rótulo -> (código inteiro, dicionário)
+PAIR_KEYS = ["Dep_ID", "SKU_ID"]
+CUBE_KEYS = [*PAIR_KEYS, "Data"]
+STATE_FILE = "estado_stats.parquet"
+QUANTILE_FILE = "sketch_quantis.parquet"
+QUANTILE_ALPHA = 0.01  # erro relativo do P95 incremental
+DD_GAMMA = (1 + QUANTILE_ALPHA) / (1 - QUANTILE_ALPHA)
+DD_BIAS = 4000  # desloca log_gamma(|x|) para manter valores fracionários (>= ~1e-17) em buckets positivos
+CUBE_SCHEMA = {"Dep_ID": pl.UInt32, "SKU_ID": pl.UInt32, "Data": pl.Date, "Qtd_Dia": pl.Float64, "Linhas": pl.UInt32, "Pedidos": pl.UInt32}
+STATE_SCHEMA = {"Dep_ID": pl.UInt32, "SKU_ID": pl.UInt32, "N": pl.Int64, "Soma": pl.Float64, "SomaQuad": pl.Float64, "Máximo": pl.Float64}
+QUANTILE_SCHEMA = {"Dep_ID": pl.UInt32, "SKU_ID": pl.UInt32, "Bucket": pl.Int32, "N": pl.Int64}
+HLL_SCHEMA = {"Dep_ID": pl.UInt32, "SKU_ID": pl.UInt32, "Reg": pl.UInt16, "Rho": pl.UInt8}
+HLL_FILE = "hll_pedidos.parquet"
+VERSION_FILE = "versao_agregados.txt"  # gravado por último em update_aggregates: chave do cache de consultas
+EXPORT_DIR = "exportacoes"
+EXPORT_FORMATS = {  # rótulo -> (extensão, compressão do sink)
+    "CSV": (".csv", "uncompressed"),
+    "CSV (gzip)": (".csv.gz", "gzip"),
+    "CSV (zstd)": (".csv.zst", "zstd"),
+    "Parquet": (".parquet", "parquet"),
+}
+EXCEL_MAX_ROWS = 1_048_576  # limite de linhas por aba do Excel
+EXCEL_MAX_SHEETS = 5  # acima disso o Excel fica impraticável: exporta CSV
+EXCEL_BATCH_ROWS = 50_000
+STATS_FILE = "estatisticas.parquet"
+CONFIG_FILE = "config.json"  # mapeamento usado no workspace (permite acrescentar arquivos depois)
+WORKSPACE_MARKERS = [CONFIG_FILE, STATE_FILE, CUBE_FILE, STORE_DIR]  # reset_workspace só apaga pastas com um destes
+DIM_FILES = {"SKU": "dim_sku.parquet", "Depósito": "dim_deposito.parquet"}
+HLL_P = 12  # 4096 registradores -> erro padrão ~1,04/sqrt(4096) = 1,6%
+HLL_SEED = 42
+HLL_ERROR = 1.04 / math.sqrt(1 << HLL_P)
+SAMPLE_ROWS = 100  # linhas lidas para a amostra da Etapa 1
+TABLE_PAGE_ROWS = 100  # linhas por página da tabela de estatísticas no dashboard
+LABEL_LIMIT = 200  # opções enviadas ao navegador por filtro (o restante aparece pela busca)
+LABEL_SOURCES = {"SKU": ("SKU", "Descrição"), "Depósito": ("Código Depósito", "Depósito")}  # filtro -> (código, descrição)
+TABLE_SEARCH_COLS = ["SKU", "Descrição", "Código Depósito", "Depósito"]
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+XLSX_DATE_FMTS = {14, 15, 16, 17, 18, 19, 20, 21, 22, 45, 46, 47}  # formatos numéricos nativos de data/hora
+ROW_GROUP_ROWS = 64_000  # row groups pequenos + SKU ordenado = estatísticas seletivas por SKU
+STAGING_ROW_GROUP_ROWS = 2_048  # lotes de preparo: cada onda de write_partitioned lê só os row groups das suas partições
+STAGING_COMPRESSION = "lz4"  # preparo é temporário: compressão rápida em vez de compacta
+MAX_WORKERS = int(os.environ.get("DS_MAX_WORKERS", 0)) or min(32, os.cpu_count() or 1)
+BYTES_PER_ROW = 256  # estimativa de memória por linha em trânsito (texto + colunas convertidas)
+METRICS_CACHE_MAX_BYTES = int(float(os.environ.get("DS_METRICS_CACHE_MB", 256)) * 1024**2)
+_cache_lock = threading.Lock()
+_cache_pins = Counter()  # entradas do cache em uso por process_save_chunk; evict_cache não as apaga
+PERF_MAX_RECORDS = 500  # registros de desempenho mantidos por workspace
+PERF_SAMPLE_S = 0.02  # intervalo de amostragem do RSS durante uma etapa
+PERF_PLAN_MIN_S = 0.5  # etapas mais lentas que isso guardam o plano otimizado do polars
+PERF_LOG_FILE = os.environ.get("DS_PERF_LOG")  # JSON lines com um registro por etapa medida
+log = logging.getLogger("motor")
+
+def init_env():
+    for d in [TEMP_DIR, SESSIONS_DIR, PROJECTS_DIR, CACHE_DIR]: os.makedirs(d, exist_ok=True)
+    if PERF_LOG_FILE: enable_perf_log(PERF_LOG_FILE)
+    # Limpa workspaces de sessões abandonadas (os dados continuam no cache)
+    for name in os.listdir(SESSIONS_DIR):
+        path = os.path.join(SESSIONS_DIR, name)
+        try:
+            if time.time() - os.path.getmtime(path) > SESSION_TTL_H * 3600: shutil.rmtree(path)
+        except: pass
+
+def check_workspace(ws):
+    # Um workspace nunca pode ser (nem conter) as pastas do motor ou a pasta atual
+    path = os.path.abspath(ws)
+    for protected in [TEMP_DIR, PROJECTS_DIR, SESSIONS_DIR, CACHE_DIR, os.getcwd()]:
+        p = os.path.abspath(protected)
+        if p == path or p.startswith(path.rstrip(os.sep) + os.sep): raise ValueError(f"Workspace inválido (contém {protected}): {ws}")
+
+def reset_workspace(ws):
+    # Só apaga pastas vazias ou que já são workspaces do motor
+    check_workspace(ws)
+    if os.path.exists(ws):
+        if os.listdir(ws) and not any(os.path.exists(os.path.join(ws, m)) for m in WORKSPACE_MARKERS):
+            raise ValueError(f"{ws} não é um workspace do motor; escolha uma pasta vazia ou nova")
+        shutil.rmtree(ws)
+    os.makedirs(ws)
+
+# ==============================================================================
+# INSTRUMENTAÇÃO (TEMPO, LINHAS, BYTES E PICO DE MEMÓRIA POR ETAPA)
+# ==============================================================================
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as fh: return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except:
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except: return None
+
+def enable_perf_log(path):
+    if any(getattr(h, "baseFilename", None) == os.path.abspath(path) for h in log.handlers): return
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+class PerfLog:
+    # Registros por workspace para o painel de desempenho; cada registro também vai para o logger "motor"
+    # como uma linha JSON. O RSS é do processo inteiro (etapas simultâneas dividem o mesmo pico).
+    def __init__(self, max_records):
+        self.max_records = max_records
+        self._records, self._active = {}, {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample(self):
+        while True:
+            time.sleep(PERF_SAMPLE_S)
+            rss = rss_bytes() or 0
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                for rec in self._active.values(): rec["_pico"] = max(rec["_pico"], rss)
+
+    @contextmanager
+    def measure(self, stage, ws=TEMP_DIR, **info):
+        # O chamador preenche linhas/bytes no dicionário e pode pôr a consulta principal (LazyFrame) em "plano".
+        # Só etapas lentas guardam o plano, já como texto: o LazyFrame pode prender dados em memória.
+        rss = rss_bytes()
+        rec = {"etapa": stage, "inicio": time.strftime("%Y-%m-%d %H:%M:%S"), **info, "linhas": None, "bytes_lidos": None, "bytes_gravados": None, "_pico": rss or 0}
+        with self._lock:
+            self._active[id(rec)] = rec
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        t0 = time.perf_counter()
+        try: yield rec
+        except Exception as e:
+            rec["erro"] = str(e) or type(e).__name__
+            raise
+        finally:
+            rec["segundos"] = round(time.perf_counter() - t0, 4)
+            with self._lock: self._active.pop(id(rec), None)
+            peak = max(rec.pop("_pico"), rss_bytes() or 0)
+            rec["pico_rss_mb"] = round(peak / 1024**2, 1) if rss else None
+            plan = rec.pop("plano", None)
+            log.info(json.dumps({"ws": ws, **rec}, ensure_ascii=False, default=str))
+            if plan is not None and rec["segundos"] >= PERF_PLAN_MIN_S:
+                try: rec["plano"] = plan.explain()
+                except: pass
+            with self._lock: self._records.setdefault(ws, deque(maxlen=self.max_records)).append(rec)
+
+    def records(self, ws):
+        with self._lock: return list(self._records.get(ws, ()))
+
+    def clear(self, ws):
+        with self._lock: self._records.pop(ws, None)
+
+perf_log = PerfLog(PERF_MAX_RECORDS)
+measure = perf_log.measure
+
+def file_size(file):
+    try: return file.size
+    except AttributeError:
+        try: return os.fstat(file.fileno()).st_size
+        except: return None
+
+def disk_path(file):
+    # Arquivo aberto do disco (linha de comando): o polars lê pelo caminho (mmap) em vez de copiar tudo para a memória
+    try:
+        os.fstat(file.fileno())
+        return file.name
+    except (AttributeError, OSError): return None
+
+def path_size(path):
+    try: return os.path.getsize(path)
+    except OSError: return 0
+
+def store_bytes(run_id=None, ws=TEMP_DIR):
+    return sum(path_size(p) for p in glob.glob(os.path.join(ws, STORE_DIR, "**", f"chunk_{run_id}_*.parquet" if run_id else "*.parquet"), recursive=True))
+
+# ==============================================================================
+# MOTOR DE DADOS (DISK BASED)
+# ==============================================================================
+
+def log_fallback(file, what, engine, err, t0, rec=None):
+    # Leitura caiu para um motor mais lento: registra motivo e tempo no log (e no registro da etapa, se houver)
+    info = {"arquivo": file.name, "leitura": what, "motor": engine, "motivo": str(err) or type(err).__name__, "segundos": round(time.perf_counter() - t0, 4)}
+    log.warning(json.dumps({"etapa": "fallback excel", **info}, ensure_ascii=False))
+    if rec is not None: rec.update({"motor_excel": engine, "fallback_s": info["segundos"], "fallback_motivo": info["motivo"]})
+
+def _xlsx_workbook(zf):
+    # Abas de planilha (sem gráficos) na ordem do workbook -> XML dentro do zip, e a época das datas
+    rels = {r.get("Id"): r.get("Target") for r in ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))}
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    sheets = {}
+    for sh in wb.iter(XLSX_NS + "sheet"):
+        target = rels.get(sh.get(XLSX_REL_ID), "")
+        if "worksheets/" in target: sheets[sh.get("name")] = target.lstrip("/") if target.startswith("/") else "xl/" + target
+    pr = wb.find(XLSX_NS + "workbookPr")
+    epoch = datetime(1904, 1, 1) if pr is not None and pr.get("date1904") in ("1", "true") else datetime(1899, 12, 30)
+    return sheets, epoch
+
+def _xlsx_shared_strings(zf, needed):
+    # sharedStrings.xml só até o maior índice usado nas linhas lidas
+    if not needed or "xl/sharedStrings.xml" not in zf.namelist(): return {}
+    out, last, i = {}, max(needed), 0
+    with zf.open("xl/sharedStrings.xml") as fh:
+        for _, el in ET.iterparse(fh):
+            if el.tag != XLSX_NS + "si": continue
+            if i in needed: out[i] = "".join(t.text or "" for t in [*el.findall(XLSX_NS + "t"), *el.findall(f"{XLSX_NS}r/{XLSX_NS}t")])
+            el.clear()
+            if i >= last: break
+            i += 1
+    return out
+
+def _xlsx_date_styles(zf):
+    # Índices de estilo (atributo s das células) com formato de data/hora
+    try: root = ET.fromstring(zf.read("xl/styles.xml"))
+    except KeyError: return set()
+    fmts = set(XLSX_DATE_FMTS)
+    for f in root.iter(XLSX_NS + "numFmt"):
+        code = re.sub(r'"[^"]*"|\\.|\[[^\]]*\]', "", f.get("formatCode", "").lower())
+        if re.search(r"[dmyhs]", code): fmts.add(int(f.get("numFmtId")))
+    xfs = root.find(XLSX_NS + "cellXfs")
+    return {i for i, xf in enumerate(xfs if xfs is not None else []) if int(xf.get("numFmtId", 0)) in fmts}
+
+def _xlsx_col(ref):
+    n = 0
+    for ch in ref:
+        if ch.isdigit(): break
+        n = n * 26 + ord(ch.upper()) - 64
+    return n - 1
+
+def _excel_text(v):
+    if v is None or isinstance(v, str): return v
+    if isinstance(v, bool): return str(v).lower()
+    if isinstance(v, datetime): return v.isoformat(" ")
+    return str(int(v)) if float(v).is_integer() else str(v)
+
+def xlsx_head(file, sheet=None, n_rows=SAMPLE_ROWS) -> pl.DataFrame:
+    # Cabeçalho + primeiras n_rows linhas da aba direto do XML, parando ali (o calamine carrega a aba inteira).
+    # Colunas em texto, com os mesmos nomes que o calamine gera: __UNNAMED__i para vazias, _1 para repetidas.
+    if hasattr(file, 'seek'): file.seek(0)
+    with zipfile.ZipFile(file) as zf:
+        sheets, epoch = _xlsx_workbook(zf)
+        if sheet is not None and sheet not in sheets: raise ValueError(f"Aba não encontrada: {sheet}")
+        rows = []
+        with zf.open(sheets[sheet] if sheet is not None else next(iter(sheets.values()))) as fh:
+            for _, el in ET.iterparse(fh):
+                if el.tag != XLSX_NS + "row": continue
+                cells, j = {}, -1
+                for c in el.iter(XLSX_NS + "c"):
+                    j = _xlsx_col(c.get("r")) if c.get("r") else j + 1
+                    t = c.get("t", "n")
+                    v = "".join(x.text or "" for x in c.iter(XLSX_NS + "t")) if t == "inlineStr" else c.findtext(XLSX_NS + "v")
+                    if v is not None: cells[j] = (t, v, int(c.get("s", 0)))
+                el.clear()
+                if cells or rows: rows.append(cells)
+                if len(rows) > n_rows: break
+        strings = _xlsx_shared_strings(zf, {int(v) for r in rows for t, v, _ in r.values() if t == "s"})
+        date_styles = _xlsx_date_styles(zf)
+
+    def value(cell):
+        t, v, st = cell
+        if t == "s": return strings.get(int(v))
+        if t == "b": return v == "1"
+        if t in ("inlineStr", "str", "e", "d"): return v
+        num = float(v)
+        return epoch + timedelta(seconds=round(num * 86400)) if st in date_styles else num
+
+    if not rows: return pl.DataFrame()
+    first = min(j for r in rows for j in r)
+    width = max(j for r in rows for j in r) + 1 - first
+    names, seen = [], {}
+    for i in range(width):
+        h = value(rows[0][first + i]) if first + i in rows[0] else None
+        name = _excel_text(h) if h not in (None, "") and not isinstance(h, bool) else f"__UNNAMED__{i}"
+        k = seen.get(name, 0)
+        seen[name] = k + 1
+        names.append(f"{name}_{k}" if k else name)
+    data = {n: [_excel_text(value(r[first + i])) if first + i in r else None for r in rows[1:]] for i, n in enumerate(names)}
+    return pl.DataFrame(data, schema={n: pl.Utf8 for n in names})
+
+def excel_sheets(file) -> list:
+    if hasattr(file, 'seek'): file.seek(0)
+    try:
+        with zipfile.ZipFile(file) as zf: return list(_xlsx_workbook(zf)[0])
+    except Exception as e:
+        # .xlsm/.xlsb fora do padrão: o fastexcel abre o arquivo
+        import fastexcel
+        t0 = time.perf_counter()
+        file.seek(0)
+        try: return fastexcel.read_excel(file.read()).sheet_names
+        finally: log_fallback(file, "abas", "fastexcel", e, t0)
+
+def read_excel_head(file, sheet=None, n_rows=SAMPLE_ROWS, rec=None) -> pl.DataFrame:
+    try: return xlsx_head(file, sheet, n_rows)
+    except Exception as e:
+        t0 = time.perf_counter()
+        file.seek(0)
+        try: return pl.read_excel(file, engine="calamine", sheet_name=sheet, read_options={"n_rows": n_rows})
+        finally: log_fallback(file, f"{n_rows} linhas", "calamine", e, t0, rec)
+
+def read_file_chunk(file, sheet=None, rec=None) -> pl.DataFrame:
+    if hasattr(file, 'seek'): file.seek(0)
+    try:
+        if file.name.endswith('.csv'): return pl.read_csv(file, ignore_errors=True, infer_schema_length=0)
+        else:
+            try: return pl.read_excel(file, engine="calamine", sheet_name=sheet)
+            except Exception as e:
+                import pandas as pd  # só no fallback: o caminho normal não carrega pandas
+                t0 = time.perf_counter()
+                file.seek(0)
+                try: return pl.from_pandas(pd.read_excel(file, sheet_name=sheet or 0))
+                finally: log_fallback(file, "aba inteira", "openpyxl", e, t0, rec)
+    except: return pl.DataFrame()
+
+def load_sample_optimized(file, sheet=None, ws=TEMP_DIR) -> pl.DataFrame:
+    with measure("amostra", ws, arquivo=file.name) as rec:
+        if hasattr(file, 'seek'): file.seek(0)
+        try:
+            if file.name.endswith('.csv'): df = pl.read_csv(file, n_rows=SAMPLE_ROWS, ignore_errors=True)
+            else: df = read_excel_head(file, sheet, rec=rec)
+        except: df = pl.DataFrame()
+        rec["linhas"], rec["bytes_lidos"] = df.height, file_size(file)
+        return df
+
+def read_header(file, sheet=None) -> list:
+    # Só o cabeçalho: CSV pelo schema do scan lazy, Excel pela primeira linha do XML
+    if hasattr(file, 'seek'): file.seek(0)
+    try:
+        if file.name.endswith('.csv'): return pl.scan_csv(file, ignore_errors=True, infer_schema=False).collect_schema().names()
+        return read_excel_head(file, sheet, 0).columns
+    except: return load_sample_optimized(file, sheet).columns
+
+def save_dimension(file, key_col, desc_col, kind, ws=TEMP_DIR):
+    # Converte a dimensão uma única vez para Parquet (K, D) ordenado pela chave; só as duas colunas são lidas
+    if hasattr(file, 'seek'): file.seek(0)
+    if file.name.endswith('.csv'): lf = pl.scan_csv(file, ignore_errors=True, infer_schema=False)
+    else:
+        try: lf = pl.read_excel(file, engine="calamine", columns=list(dict.fromkeys([key_col, desc_col]))).lazy()
+        except: lf = read_file_chunk(file).lazy()
+    dim = (lf.select([pl.col(key_col).cast(pl.Utf8).alias("K"), pl.col(desc_col).cast(pl.Utf8).alias("D")])
+        .filter(pl.col("K").is_not_null()).unique("K", keep="first", maintain_order=True).sort("K").collect())
+    _write(dim, os.path.join(ws, DIM_FILES[kind]))
+    return dim.height
+
+def join_dimension(stats, kind, on, alias, ws=TEMP_DIR):
+    path = os.path.join(ws, DIM_FILES[kind])
+    if not os.path.exists(path): return stats.with_columns(pl.lit("-").alias(alias))
+    return stats.join(pl.read_parquet(path), left_on=on, right_on="K", how="left").rename({"D": alias})
+
+def scan_file_lazy(file, sheet=None, rec=None) -> pl.LazyFrame:
+    # CSV vira um scan lazy (tudo Utf8, igual ao infer_schema_length=0); Excel é lido uma aba por vez
+    if hasattr(file, 'seek'): file.seek(0)
+    if file.name.endswith('.csv'): return pl.scan_csv(disk_path(file) or file, ignore_errors=True, infer_schema=False)
+    return read_file_chunk(file, sheet, rec).lazy()
+
+def resolve_sheets(file, sheets, required=()):
+    # None = primeira aba; "*" = todas as abas com as colunas mapeadas; lista = exatamente essas abas
+    names = excel_sheets(file)
+    if not sheets: return names[:1]
+    if sheets == "*": return [sh for sh in names if set(required) <= set(read_header(file, sh))]
+    missing = [sh for sh in sheets if sh not in names]
+    if missing: raise ValueError(f"Aba(s) não encontrada(s): {', '.join(missing)}")
+    return list(sheets)
+
+def _as_datetime(col, dtype):
+    if dtype == pl.Utf8: return pl.col(col).str.to_datetime(strict=False)
+    return pl.col(col).cast(pl.Datetime, strict=False)
+
+def _as_time(col, dtype):
+    if dtype == pl.Utf8: return pl.col(col).str.to_time(strict=False)
+    return pl.col(col).cast(pl.Time, strict=False)
+
+def build_clean_exprs(schema, mapping, split_dt, dt_source):
+    # Mesmas expressões de cast para o arquivo inteiro ou para cada lote
+    exprs = []
+    if split_dt and dt_source in schema:
+        try:
+            tc = _as_datetime(dt_source, schema[dt_source])
+            exprs.extend([tc.dt.date().alias("Data"), tc.dt.time().alias("Hora")])
+        except:
+            exprs.extend([pl.col(dt_source).cast(pl.Utf8).alias("Data"), pl.lit(None).alias("Hora")])
+    else:
+        for target in ["Data", "Hora"]:
+            src = mapping.get(target)
+            if src and src in schema:
+                if target == "Data":
+                    try: exprs.append(_as_datetime(src, schema[src]).dt.date().alias("Data"))
+                    except: exprs.append(pl.col(src).alias("Data"))
+                else:
+                    try: exprs.append(_as_time(src, schema[src]).alias("Hora"))
+                    except: exprs.append(pl.col(src).alias("Hora"))
+            else:
+                exprs.append(pl.lit(None).alias(target))
+
+    target_cols = ["Depósito", "SKU", "Pedido", "Caixa", "Quantidade", "Rota/Destino"]
+    for target in target_cols:
+        src = mapping.get(target)
+        if src and src in schema:
+            if target == "Quantidade":
+                exprs.append(pl.col(src).cast(pl.Utf8).str.replace(",", ".").cast(pl.Float64, strict=False).fill_null(0.0).cast(pl.Float32).alias(target))
+            else:
+                exprs.append(pl.col(src).cast(pl.Utf8, strict=False).fill_null("").alias(target))
+        else:
+            if target == "Quantidade": exprs.append(pl.lit(0.0, dtype=pl.Float32).alias(target))
+            else: exprs.append(pl.lit("", dtype=pl.Utf8).alias(target))
+    return exprs
+
+def new_run_id():
+    return time.strftime("%Y%m%d%H%M%S") + uuid.uuid4().hex[:6]
+
+def file_digest(file):
+    if hasattr(file, 'seek'): file.seek(0)
+    h = hashlib.blake2b(digest_size=20)
+    for block in iter(lambda: file.read(1 << 20), b""): h.update(block)
+    file.seek(0)
+    return h.hexdigest()
+
+def cache_key(file, mapping, split_dt, dt_source, sheets=None):
+    # Mesmo conteúdo + mesmo mapeamento (e mesmas abas) = mesma saída Parquet, em qualquer sessão
+    cfg = json.dumps({"v": CACHE_VERSION, "ext": os.path.splitext(file.name)[1].lower(), "mapping": mapping, "split_dt": split_dt, "dt_source": dt_source, "sheets": sheets}, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b((file_digest(file) + cfg).encode(), digest_size=20).hexdigest()
+
+def evict_cache():
+    # LRU pelo mtime do meta.json (atualizado a cada uso) até caber em CACHE_MAX_BYTES; pula as entradas em uso
+    with _cache_lock:
+        entries = []
+        for name in os.listdir(CACHE_DIR):
+            if ".tmp-" in name: continue  # entrada ainda sendo gravada (ainda não renomeada)
+            meta = os.path.join(CACHE_DIR, name, CACHE_META)
+            try:
+                with open(meta) as fh: entries.append((os.path.getmtime(meta), json.load(fh)["bytes"], name))
+            except: continue
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= CACHE_MAX_BYTES: break
+            if _cache_pins[name]: continue
+            shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+            total -= size
+
+def link_cache_entry(entry, dest_dir, prefix):
+    # Hardlink (ou cópia) das partes do cache para o store da sessão, com o prefixo do lote
+    for root, _, names in os.walk(entry):
+        for name in names:
+            if not name.endswith(".parquet"): continue
+            target_dir = os.path.join(dest_dir, os.path.relpath(root, entry))
+            os.makedirs(target_dir, exist_ok=True)
+            target = os.path.join(target_dir, prefix + name)
+            try: os.link(os.path.join(root, name), target)
+            except OSError: shutil.copy2(os.path.join(root, name), target)
+
+def link_workspace(src, dest):
+    # Cópia de um projeto para o workspace da sessão com hardlinks (ou cópia). O app só grava arquivos novos
+    # ou troca o arquivo inteiro (_write), então o projeto original não muda; exportações ficam de fora
+    for root, dirs, names in os.walk(src):
+        if root == src and EXPORT_DIR in dirs: dirs.remove(EXPORT_DIR)
+        target_dir = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in names:
+            target = os.path.join(target_dir, name)
+            try: os.link(os.path.join(root, name), target)
+            except OSError: shutil.copy2(os.path.join(root, name), target)
+
+def process_save_chunk(file, idx, mapping, split_dt, dt_source, batch_rows=None, run_id="0", ws=TEMP_DIR, sheets=None):
+    # Reaproveita a saída do cache quando o mesmo arquivo já foi processado com o mesmo mapeamento.
+    # Retorna as linhas gravadas; erros sobem para quem chamou (ingest_files reporta por arquivo).
+    with measure("ingestão", ws, arquivo=file.name) as rec:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        t0 = time.perf_counter()
+        key = cache_key(file, mapping, split_dt, dt_source, sheets)
+        rec["hash_s"] = round(time.perf_counter() - t0, 4)
+        rec["bytes_lidos"] = file_size(file)
+        with _cache_lock: _cache_pins[key] += 1  # fixa a entrada antes de checar: nenhum evict_cache a apaga até o fim
+        try:
+            entry = os.path.join(CACHE_DIR, key)
+            meta = os.path.join(entry, CACHE_META)
+            rec["cache"] = os.path.exists(meta)
+            if rec["cache"]: os.utime(meta)
+            else:
+                tmp = f"{entry}.tmp-{uuid.uuid4().hex[:8]}"
+                try: rows = ingest_to_dir(file, tmp, mapping, split_dt, dt_source, batch_rows, rec, sheets)
+                except:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+                with open(os.path.join(tmp, CACHE_META), "w") as fh:
+                    json.dump({"linhas": rows, "bytes": dir_size(tmp), "arquivo": file.name}, fh, ensure_ascii=False)
+                try: os.rename(tmp, entry)
+                except OSError: shutil.rmtree(tmp, ignore_errors=True)  # outra sessão gravou a mesma entrada antes
+            link_cache_entry(entry, os.path.join(ws, STORE_DIR), f"chunk_{run_id}_{idx}_")
+            evict_cache()
+            with open(meta) as fh: info = json.load(fh)
+            rec["linhas"], rec["bytes_gravados"] = info["linhas"], info["bytes"]
+            return info["linhas"]
+        finally:
+            with _cache_lock:
+                _cache_pins[key] -= 1
+                if not _cache_pins[key]: del _cache_pins[key]
+
+def ingest_to_dir(file, base_dir, mapping, split_dt, dt_source, batch_rows=None, rec=None, sheets=None):
+    # Ingestão em streaming: o pico de memória é limitado por batch_rows, não pelo tamanho do arquivo.
+    # O sink nativo grava partes brutas de até batch_rows linhas (com contrapressão: collect_batches acumula
+    # lotes quando o consumidor é mais lento que o leitor); sort_staged ordena cada parte e write_partitioned
+    # grava um único arquivo por partição. Excel: uma aba por vez (sheets, ver resolve_sheets). rec (opcional)
+    # recebe o plano e a divisão do tempo entre leitura do Excel, leitura/conversão, ordenação e particionamento.
+    batch_rows = batch_rows or BATCH_ROWS
+    rec = {} if rec is None else rec
+    if file.name.endswith('.csv'): targets = [None]
+    else:
+        required = [c for c in [*mapping.values(), dt_source if split_dt else None] if c and not c.startswith("---")]
+        targets = resolve_sheets(file, sheets, required)
+        if not targets: raise ValueError("Nenhuma aba com todas as colunas mapeadas")
+        rec["abas"], rec["leitura_excel_s"] = len(targets), 0.0
+    staging = os.path.join(base_dir, "_preparo")
+    t0 = time.perf_counter()
+    for n, sheet in enumerate(targets):
+        t1 = time.perf_counter()
+        lf = scan_file_lazy(file, sheet, rec)
+        if sheet is not None: rec["leitura_excel_s"] = round(rec["leitura_excel_s"] + time.perf_counter() - t1, 4)
+        schema = lf.collect_schema()
+        if not schema:
+            if len(targets) == 1: raise ValueError("Arquivo vazio ou ilegível")
+            continue
+
+        lf = lf.select(build_clean_exprs(schema, mapping, split_dt, dt_source))
+        rec["plano"] = lf
+        lf.sink_parquet(pl.PartitionBy(os.path.join(staging, f"aba{n}"), max_rows_per_file=batch_rows), compression=STAGING_COMPRESSION, mkdir=True)
+    rec["leitura_conversao_s"] = round(time.perf_counter() - t0 - rec.get("leitura_excel_s", 0.0), 4)
+    t1 = time.perf_counter()
+    parts = sort_staged(staging)
+    rows = sum(n for _, n in parts.values())
+    rec["ordenacao_s"] = round(time.perf_counter() - t1, 4)
+    if rows == 0: raise ValueError("Nenhuma linha encontrada")
+    t1 = time.perf_counter()
+    write_partitioned(staging, parts, base_dir, batch_rows)
+    shutil.rmtree(staging)
+    rec["particionamento_s"] = round(time.perf_counter() - t1, 4)
+    return rows
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, n)) for root, _, names in os.walk(path) for n in names)
+
+def sort_staged(staging):
+    # Cada parte bruta vira um lote ordenado por partição e SKU, com a partição como inteiro _p (o mesmo id
+    # em todos os lotes). Retorna {(Depósito, AnoMes): [_p, linhas]}; a memória é a de uma parte por vez
+    parts = {}
+    raw = sorted(glob.glob(os.path.join(staging, "aba*", "*.parquet")))
+    for i, path in enumerate(raw):
+        batch = pl.read_parquet(path).with_columns(pl.col("Data").dt.strftime("%Y-%m").alias("AnoMes"))
+        os.remove(path)
+        if batch.is_empty(): continue
+        counts = batch.group_by(PARTITION_COLS).len()
+        keys = list(counts.select(PARTITION_COLS).iter_rows())
+        for key, n in zip(keys, counts["len"]): parts.setdefault(key, [len(parts), 0])[1] += n
+        ids = counts.select(PARTITION_COLS).with_columns(pl.Series("_p", [parts[k][0] for k in keys], dtype=pl.UInt32))
+        batch = batch.join(ids, on=PARTITION_COLS, how="left", nulls_equal=True).sort(["_p", "SKU"])
+        batch.write_parquet(os.path.join(staging, f"lote{i}.parquet"), compression=STAGING_COMPRESSION, statistics=True, row_group_size=STAGING_ROW_GROUP_ROWS)
+    return parts
+
+def write_partitioned(staging, parts, base_dir, max_rows):
+    # Uma pasta por Depósito/AnoMes com um único arquivo ordenado por SKU, por arquivo de entrada.
+    # Sem sort global: as partições saem em ondas de até max_rows linhas (uma partição maior vai sozinha),
+    # e o sort em memória de cada onda fica limitado pelo tamanho da onda, não pelo do arquivo
+    waves, lo, acc = [], 0, 0
+    for p, n in sorted(parts.values()):
+        if acc and acc + n > max_rows: waves.append((lo, p - 1)); lo, acc = p, 0
+        acc += n
+    waves.append((lo, len(parts) - 1))
+    lf = pl.scan_parquet(os.path.join(staging, "lote*.parquet"))
+    for lo, hi in waves:
+        wave = lf.filter(pl.col("_p").is_between(lo, hi)).sort(["_p", "SKU"]).drop("_p")
+        wave.sink_parquet(pl.PartitionBy(base_dir, key=PARTITION_COLS, include_key=False), statistics=True, row_group_size=ROW_GROUP_ROWS, mkdir=True)
+
+def scan_store(run_id=None, ws=TEMP_DIR) -> pl.LazyFrame:
+    # run_id restringe o scan aos arquivos de um lote de ingestão (usado no modo de acréscimo)
+    return pl.scan_parquet(
+        os.path.join(ws, STORE_DIR, "**", f"chunk_{run_id}_*.parquet" if run_id else "*.parquet"), hive_partitioning=True,
+        hive_schema={"Depósito": pl.Utf8, "AnoMes": pl.Utf8}
+    ).select(STORE_COLS)
+
+def available_memory():
+    try: return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except: return None
+
+def ingest_workers(files, batch_rows=None):
+    # Arquivos simultâneos: limitado pelos núcleos e pela memória livre (estimativa por lote)
+    batch_rows = batch_rows or BATCH_ROWS
+    workers = min(MAX_WORKERS, len(files)) or 1
+    mem = available_memory()
+    if mem:
+        per_file = max(min(getattr(f, 'size', 0) or batch_rows * BYTES_PER_ROW, batch_rows * BYTES_PER_ROW) * 3 for f in files)
+        workers = max(1, min(workers, int(mem * 0.5) // max(per_file, 1)))
+    return workers
+
+def ingest_files(files, mapping, split_dt, dt_source, run_id, on_progress=None, batch_rows=None, ws=TEMP_DIR, sheets=None):
+    # Threads em vez de processos: o polars libera o GIL no parse/cast/escrita e os
+    # UploadedFile do Streamlit não precisam ser serializados para outro processo.
+    errors = []
+    with ThreadPoolExecutor(max_workers=ingest_workers(files, batch_rows)) as pool:
+        futures = {pool.submit(process_save_chunk, f, i, mapping, split_dt, dt_source, batch_rows, run_id, ws, sheets): f for i, f in enumerate(files)}
+        for done, fut in enumerate(as_completed(futures), 1):
+            f = futures[fut]
+            try: fut.result()
+            except Exception as e: errors.append((f.name, str(e) or type(e).__name__))
+            if on_progress: on_progress(done, len(files), f.name)
+    gc.collect()
+    return errors
+
+def scan_cube(ws=TEMP_DIR) -> pl.LazyFrame:
+    return pl.scan_parquet(os.path.join(ws, CUBE_FILE))
+
+def hll_registers(col, by):
+    # HyperLogLog esparso: (registrador, rho) por grupo; mesclar sketches = max(rho) por registrador
+    h = pl.col(col).hash(seed=HLL_SEED)
+    rest = h % (1 << (64 - HLL_P))
+    return [*by, (h // (1 << (64 - HLL_P))).cast(pl.UInt16).alias("Reg"), (rest.bitwise_leading_zeros() - HLL_P + 1).cast(pl.UInt8).alias("Rho")]
+
+def hll_estimate(lf) -> int:
+    m = 1 << HLL_P
+    regs = lf.group_by("Reg").agg(pl.col("Rho").max()).collect()
+    if regs.is_empty(): return 0
+    zeros = m - regs.height
+    z = regs.select((2.0 ** -pl.col("Rho").cast(pl.Float64)).sum()).item() + zeros
+    est = (0.7213 / (1 + 1.079 / m)) * m * m / z
+    if est <= 2.5 * m and zeros > 0: est = m * math.log(m / zeros)
+    return int(round(est))
+
+def dd_bucket(x):
+    # Bucket do sketch de quantis (estilo DDSketch, erro relativo QUANTILE_ALPHA); a ordem dos buckets segue a dos valores
+    k = (x.abs().log() / math.log(DD_GAMMA)).ceil() + DD_BIAS
+    return pl.when(x == 0).then(0).otherwise(x.sign() * k.clip(1, None)).cast(pl.Int32)
+
+def dd_value(b):
+    k = b.abs().cast(pl.Float64) - DD_BIAS
+    return pl.when(b == 0).then(0.0).otherwise(b.sign() * (DD_GAMMA ** k) * 2 / (DD_GAMMA + 1))
+
+def _read_or_empty(path, schema):
+    return pl.read_parquet(path) if os.path.exists(path) else pl.DataFrame(schema=schema)
+
+def _write(df, path):
+    # Escreve ao lado e troca: um erro no meio não deixa o agregado pela metade
+    df.write_parquet(path + ".tmp", statistics=True, row_group_size=ROW_GROUP_ROWS)
+    os.replace(path + ".tmp", path)
+
+def load_keys(label, ws=TEMP_DIR):
+    id_col, file_name = KEY_DIMS[label]
+    return _read_or_empty(os.path.join(ws, file_name), {label: pl.Utf8, id_col: pl.UInt32})
+
+def encode_keys(df, ws=TEMP_DIR):
+    # Troca Depósito/SKU por códigos inteiros densos; rótulos novos recebem o próximo código e o
+    # dicionário do workspace é regravado, então os códigos valem para todos os lotes e agregados.
+    for label, (id_col, file_name) in KEY_DIMS.items():
+        keys = load_keys(label, ws)
+        new = df.select(label).unique().join(keys, on=label, how="anti").sort(label)
+        if not new.is_empty():
+            keys = pl.concat([keys, new.with_row_index(id_col, offset=keys.height).select([label, id_col])])
+            _write(keys, os.path.join(ws, file_name))
+        df = df.join(keys, on=label, how="left").drop(label)
+    return df.select([*PAIR_KEYS, pl.exclude(PAIR_KEYS)])
+
+def decode_keys(df, ws=TEMP_DIR):
+    # Rótulos só para exibição: os agregados continuam em códigos
+    for label, (id_col, _) in KEY_DIMS.items():
+        if id_col in df.columns: df = df.join(load_keys(label, ws), on=id_col, how="left").drop(id_col)
+    return df
+
+def lookup_ids(label, values, ws=TEMP_DIR):
+    return load_keys(label, ws).filter(pl.col(label).is_in(values))[KEY_DIMS[label][0]].to_list()
+
+def update_aggregates(run_id=None, ws=TEMP_DIR):
+    # Incorpora só os arquivos do lote run_id (ou todo o store) aos agregados persistidos:
+    # cubo diário, estado das estatísticas por (Depósito, SKU), sketch de quantis e HLL de pedidos.
+    # O mesmo Depósito/SKU/dia pode vir em arquivos antigos e novos: o total do dia é somado e o
+    # estado recebe a diferença entre o valor antigo e o novo daquele dia.
+    with measure("agregados", ws, lote=run_id) as rec:
+        pair = PAIR_KEYS
+        cube_path, state_path, quantile_path, hll_path = (os.path.join(ws, f) for f in [CUBE_FILE, STATE_FILE, QUANTILE_FILE, HLL_FILE])
+        rec["bytes_lidos"] = store_bytes(run_id, ws) + sum(path_size(f) for f in [cube_path, state_path, quantile_path, hll_path])
+        rec["plano"] = scan_store(run_id, ws).group_by(["Depósito", "SKU", "Data"]).agg([
+            pl.col("Quantidade").cast(pl.Float64).sum().alias("Qtd_Dia"),
+            pl.len().cast(pl.UInt32).alias("Linhas"),
+            pl.col("Pedido").n_unique().cast(pl.UInt32).alias("Pedidos"),
+        ])
+        delta = rec["plano"].collect()
+        delta = encode_keys(delta, ws)
+        old = _read_or_empty(cube_path, CUBE_SCHEMA)
+
+        # Cubo: dias já existentes são somados (Pedidos vira limite superior se um pedido cruzar arquivos)
+        touched = delta.join(old.rename({"Qtd_Dia": "Qtd_Ant", "Linhas": "Lin_Ant", "Pedidos": "Ped_Ant"}), on=CUBE_KEYS, how="left", nulls_equal=True)
+        touched = touched.with_columns([
+            (pl.col("Qtd_Ant").fill_null(0.0) + pl.col("Qtd_Dia")).alias("Qtd_Nova"),
+            (pl.col("Lin_Ant").fill_null(0) + pl.col("Linhas")).alias("Linhas"),
+            (pl.col("Ped_Ant").fill_null(0) + pl.col("Pedidos")).alias("Pedidos"),
+        ])
+        cube = pl.concat([
+            old.join(delta.select(CUBE_KEYS), on=CUBE_KEYS, how="anti", nulls_equal=True),
+            touched.select([*CUBE_KEYS, pl.col("Qtd_Nova").alias("Qtd_Dia"), "Linhas", "Pedidos"]),
+        ]).sort(CUBE_KEYS)
+
+        # Estado das estatísticas (só dias com Data): N, Soma, SomaQuad e Máximo por par
+        days = touched.filter(pl.col("Data").is_not_null())
+        d_state = days.group_by(pair).agg([
+            pl.col("Qtd_Ant").is_null().sum().cast(pl.Int64).alias("dN"),
+            pl.col("Qtd_Dia").sum().alias("dS"),
+            (pl.col("Qtd_Nova") ** 2 - pl.col("Qtd_Ant").fill_null(0.0) ** 2).sum().alias("dQ"),
+            pl.col("Qtd_Nova").max().alias("dMax"),
+            ((pl.col("Qtd_Dia") < 0) & pl.col("Qtd_Ant").is_not_null()).any().alias("Recalc"),
+        ])
+        state = _read_or_empty(state_path, STATE_SCHEMA).join(d_state, on=pair, how="full", coalesce=True).with_columns([
+            (pl.col("N").fill_null(0) + pl.col("dN").fill_null(0)).alias("N"),
+            (pl.col("Soma").fill_null(0.0) + pl.col("dS").fill_null(0.0)).alias("Soma"),
+            (pl.col("SomaQuad").fill_null(0.0) + pl.col("dQ").fill_null(0.0)).alias("SomaQuad"),
+            pl.max_horizontal("Máximo", "dMax").alias("Máximo"),
+        ])
+        # Um dia que diminuiu pode ter sido o máximo: recalcula só esses pares a partir do cubo
+        recalc = state.filter(pl.col("Recalc").fill_null(False)).select(pair)
+        if not recalc.is_empty():
+            new_max = cube.filter(pl.col("Data").is_not_null()).join(recalc, on=pair).group_by(pair).agg(pl.col("Qtd_Dia").max().alias("Max_Recalc"))
+            state = state.join(new_max, on=pair, how="left").with_columns(pl.coalesce("Max_Recalc", "Máximo").alias("Máximo"))
+        state = state.select(list(STATE_SCHEMA)).sort(pair)
+
+        # Sketch de quantis: +1 no bucket do total novo, -1 no bucket do total antigo do mesmo dia
+        d_sketch = pl.concat([
+            days.select([*pair, dd_bucket(pl.col("Qtd_Nova")).alias("Bucket"), pl.lit(1, dtype=pl.Int64).alias("N")]),
+            days.filter(pl.col("Qtd_Ant").is_not_null()).select([*pair, dd_bucket(pl.col("Qtd_Ant")).alias("Bucket"), pl.lit(-1, dtype=pl.Int64).alias("N")]),
+        ])
+        sketch = (pl.concat([_read_or_empty(quantile_path, QUANTILE_SCHEMA), d_sketch])
+            .group_by([*pair, "Bucket"]).agg(pl.col("N").sum()).filter(pl.col("N") > 0).sort([*pair, "Bucket"]))
+
+        # HLL de pedidos: mesclar = max(rho) por registrador
+        d_hll = encode_keys(scan_store(run_id, ws).select(hll_registers("Pedido", ["Depósito", "SKU"])).group_by(["Depósito", "SKU", "Reg"]).agg(pl.col("Rho").max()).collect(), ws)
+        hll = pl.concat([_read_or_empty(hll_path, HLL_SCHEMA), d_hll]).group_by([*pair, "Reg"]).agg(pl.col("Rho").max()).sort(pair)
+
+        _write(cube, cube_path)
+        _write(state, state_path)
+        _write(sketch, quantile_path)
+        _write(hll, hll_path)
+        first, last = cube.select(pl.col("Data").min().alias("Início"), pl.col("Data").max().alias("Fim")).row(0)
+        if first is not None: _write(calendar_dim(first, last), os.path.join(ws, CALENDAR_FILE))
+        # Por último: a versão só muda quando todos os agregados já estão gravados
+        version_path = os.path.join(ws, VERSION_FILE)
+        with open(version_path + ".tmp", "w") as fh: fh.write(new_run_id())
+        os.replace(version_path + ".tmp", version_path)
+        metrics_cache.invalidate(ws)
+        rec["linhas"] = int(delta["Linhas"].sum())
+        rec["bytes_gravados"] = sum(path_size(f) for f in [cube_path, state_path, quantile_path, hll_path])
+
+def calculate_stats_table(dim_sku_file=None, key_sku=None, desc_sku=None, dim_dep_file=None, key_dep=None, desc_dep=None, ws=TEMP_DIR):
+    # Estatísticas derivadas do estado incremental; P95 exato sobre o cubo diário (o sketch de quantis só sem cubo)
+    with measure("estatísticas", ws) as rec:
+        try: state = pl.read_parquet(os.path.join(ws, STATE_FILE))
+        except: return None
+
+        cube_path = os.path.join(ws, CUBE_FILE)
+        if os.path.exists(cube_path):
+            rec["bytes_lidos"] = path_size(os.path.join(ws, STATE_FILE)) + path_size(cube_path)
+            rec["plano"] = (scan_cube(ws).filter(pl.col("Data").is_not_null())
+                .group_by(PAIR_KEYS).agg(pl.col("Qtd_Dia").quantile(0.95).alias("Percentil 95%")))
+        else:
+            # Ponto médio do bucket: pode passar do Máximo em até QUANTILE_ALPHA, então fica limitado a ele
+            rec["bytes_lidos"] = path_size(os.path.join(ws, STATE_FILE)) + path_size(os.path.join(ws, QUANTILE_FILE))
+            rank = state.select([*PAIR_KEYS, (0.95 * (pl.col("N") - 1) + 0.5).floor().alias("Rank"), "Máximo"])
+            rec["plano"] = (pl.scan_parquet(os.path.join(ws, QUANTILE_FILE)).join(rank.lazy(), on=PAIR_KEYS)
+                .with_columns(pl.col("N").cum_sum().over(PAIR_KEYS, order_by="Bucket").alias("Acum"))
+                .filter(pl.col("Acum") > pl.col("Rank"))
+                .group_by(PAIR_KEYS).agg(pl.min_horizontal(dd_value(pl.col("Bucket").min()), pl.col("Máximo").first()).alias("Percentil 95%")))
+        p95 = rec["plano"].collect()
+
+        var = (pl.col("SomaQuad") - pl.col("Soma") ** 2 / pl.col("N")) / (pl.col("N") - 1)
+        stats = state.filter(pl.col("N") > 0).join(p95, on=PAIR_KEYS, how="left").select([
+            *PAIR_KEYS,
+            (pl.col("Soma") / pl.col("N")).alias("Média"),
+            "Máximo",
+            pl.when(pl.col("N") > 1).then(var.clip(0, None).sqrt()).otherwise(0.0).alias("Desvio"),
+            "Percentil 95%",
+        ])
+        stats = decode_keys(stats, ws)
+
+        stats = stats.with_columns([
+            (pl.col("Média") + pl.col("Desvio")).alias("Média + 1 Desv"),
+            (pl.col("Média") + (pl.col("Desvio") * 2)).alias("Média + 2 Desv"),
+            (pl.col("Média") + (pl.col("Desvio") * 3)).alias("Média + 3 Desv"),
+        ])
+
+        # Dimensões enviadas agora são persistidas; sem arquivo, vale a última versão salva no workspace
+        if dim_sku_file: save_dimension(dim_sku_file, key_sku, desc_sku, "SKU", ws)
+        if dim_dep_file: save_dimension(dim_dep_file, key_dep, desc_dep, "Depósito", ws)
+        stats = join_dimension(stats, "SKU", "SKU", "Descrição", ws)
+        stats = join_dimension(stats, "Depósito", "Depósito", "Nome Depósito", ws)
+
+        stats = stats.rename({"Depósito": "Código Depósito", "Nome Depósito": "Depósito", "SKU": "SKU", "Descrição": "Descrição"})
+        cols = ["Código Depósito", "Depósito", "SKU", "Descrição", "Média", "Máximo", "Desvio", "Média + 1 Desv", "Média + 2 Desv", "Média + 3 Desv", "Percentil 95%"]
+        for c in cols: 
+            if c not in stats.columns: stats = stats.with_columns(pl.lit("-").alias(c))
+    
+        rec["linhas"] = stats.height
+        return stats.select(cols)
+
+def calendar_dim(start, end) -> pl.DataFrame:
+    # Um dia por linha com as chaves usadas pelas séries (início da semana/mês) e pelo heatmap;
+    # semanas começam no domingo nos dois (Semana e Semana_Ano)
+    wday = pl.col("Data").dt.weekday() % 7  # 0 = domingo
+    return pl.DataFrame({"Data": pl.date_range(start, end, "1d", eager=True)}).with_columns([
+        pl.col("Data").dt.year().alias("Ano"),
+        (pl.col("Data") - pl.duration(days=wday)).alias("Semana"),
+        pl.col("Data").dt.month_start().alias("Mês"),
+        wday.cast(pl.Int8).alias("Dia_Semana"),
+        ((pl.col("Data").dt.ordinal_day() + 6 - wday) // 7).cast(pl.Int8).alias("Semana_Ano"),  # igual ao %U: semanas começam no domingo
+    ])
+
+def time_series(daily, ws=TEMP_DIR) -> dict:
+    # Série diária completada com zeros pelo calendário (mantém as colunas do calendário) + totais por semana e mês
+    if daily.is_empty(): return {g: pl.DataFrame(schema={"Data": pl.Date, "Quantidade": pl.Float64}) for g in GRANULARITIES}
+    start, end = daily["Data"].min(), daily["Data"].max()
+    path = os.path.join(ws, CALENDAR_FILE)
+    cal = pl.scan_parquet(path).filter(pl.col("Data").is_between(start, end)).collect() if os.path.exists(path) else calendar_dim(start, end)
+    day = cal.join(daily, on="Data", how="left").with_columns(pl.col("Quantidade").fill_null(0.0))
+    series = {"Dia": day}
+    for g in ["Semana", "Mês"]: series[g] = day.group_by(g).agg(pl.col("Quantidade").sum()).rename({g: "Data"}).sort("Data")
+    return series
+
+def series_for_range(series, start, end):
+    # Granularidade pelo tamanho do período, para o gráfico nunca passar de ~CHART_MAX_POINTS barras
+    days = (end - start).days + 1
+    g = "Dia" if days <= CHART_MAX_POINTS else "Semana" if days <= CHART_MAX_POINTS * 7 else "Mês"
+    day = series["Dia"].filter(pl.col("Data").is_between(start, end))
+    if g == "Dia" or day.is_empty(): return g, day.select(["Data", "Quantidade"])
+    # Semanas/meses inteiros vêm pré-calculados; só as duas pontas são somadas dos dias do período,
+    # para as barras das pontas não incluírem dias fora da seleção
+    first, last = day[g].min(), day[g].max()
+    edges = day.filter(pl.col(g).is_in([first, last])).group_by(g).agg(pl.col("Quantidade").sum()).rename({g: "Data"})
+    inner = series[g].filter((pl.col("Data") > first) & (pl.col("Data") < last))
+    return g, pl.concat([inner, edges]).sort("Data")
+
+def heatmap_cells(day, start, end):
+    # Até HEATMAP_MAX_YEARS anos: uma célula por dia (Ano, Semana_Ano, Dia_Semana); acima: uma por mês (Ano, Mês 1-12)
+    day = day.filter(pl.col("Data").is_between(start, end))
+    if end.year - start.year < HEATMAP_MAX_YEARS: return "Dia", day.select(["Ano", "Semana_Ano", "Dia_Semana", "Data", "Quantidade"])
+    return "Mês", day.group_by(["Ano", pl.col("Mês").dt.month().alias("Mês")]).agg(pl.col("Quantidade").sum()).sort(["Ano", "Mês"])
+
+def label_index(stats, kind) -> pl.DataFrame:
+    # Rótulos "código - descrição" únicos e ordenados, com a versão minúscula para a busca.
+    # Montado uma vez por tabela de estatísticas em vez de a cada rerun.
+    code, desc = LABEL_SOURCES[kind]
+    return (stats.select([pl.concat_str([pl.col(code), pl.lit(" - "), pl.col(desc).fill_null("-")]).alias("Label"), pl.col(code).alias("Código")])
+        .unique("Label").sort("Label").with_columns(pl.col("Label").str.to_lowercase().alias("Busca")))
+
+def search_labels(index, term=None, limit=LABEL_LIMIT) -> list:
+    # Prefixo por busca binária no índice ordenado; completa com o texto em qualquer posição (sem maiúsculas)
+    labels = index["Label"]
+    if not term: return labels.head(limit).to_list()
+    prefix = labels.slice(labels.search_sorted(term, side="left"), limit)
+    found = prefix.filter(prefix.str.starts_with(term)).to_list()
+    if len(found) < limit: found += index.filter(pl.col("Busca").str.contains(term.lower(), literal=True))["Label"].head(limit).to_list()
+    return list(dict.fromkeys(found))[:limit]
+
+def label_codes(index, labels) -> list:
+    return index.filter(pl.col("Label").is_in(labels))["Código"].to_list()
+
+def stats_view(stats, sel_skus=None, sel_deps=None, search=None, sort_by=None, descending=False) -> pl.Series:
+    # Filtro, busca e ordenação no polars; devolve só os índices das linhas (UInt32), que o chamador
+    # guarda enquanto os filtros não mudam: trocar de página vira um recorte desse vetor
+    lf = stats.lazy().with_row_index("_i")
+    if sel_skus: lf = lf.filter(pl.col("SKU").is_in(sel_skus))
+    if sel_deps: lf = lf.filter(pl.col("Código Depósito").is_in(sel_deps))
+    if search: lf = lf.filter(pl.any_horizontal([pl.col(c).cast(pl.Utf8).str.contains("(?i)" + re.escape(search)) for c in TABLE_SEARCH_COLS]))
+    if sort_by: lf = lf.sort(sort_by, descending=descending, nulls_last=True, maintain_order=True)
+    return lf.select("_i").collect()["_i"]
+
+def stats_page(stats, view, page=0, page_size=TABLE_PAGE_ROWS) -> pl.DataFrame:
+    return stats[view.slice(page * page_size, page_size)]
+
+class ResultCache:
+    # LRU em memória para resultados de consultas do dashboard, limitado em bytes e compartilhado entre sessões
+    def __init__(self, max_bytes):
+        self.max_bytes, self.bytes, self.hits, self.misses = max_bytes, 0, 0, 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._items: self.bytes -= self._items.pop(key)[1]
+            if size > self.max_bytes: return
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self.bytes -= old_size
+
+    def invalidate(self, ws):
+        with self._lock:
+            for key in [k for k in self._items if k[0] == ws]: self.bytes -= self._items.pop(key)[1]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._items), "bytes": self.bytes}
+
+metrics_cache = ResultCache(METRICS_CACHE_MAX_BYTES)
+
+def dataset_version(ws):
+    # Muda só depois que update_aggregates grava todos os agregados (o cubo sozinho muda antes do estado e do HLL)
+    try:
+        with open(os.path.join(ws, VERSION_FILE)) as fh: return fh.read()
+    except OSError: return None
+
+def get_dashboard_metrics(sel_skus, sel_deps, drill_sku=None, drill_dep=None, exact_pick=False, ws=TEMP_DIR):
+    # Filtros normalizados (ordem e listas vazias não importam) + versão dos dados = chave do cache
+    drill = (drill_sku, drill_dep) if drill_sku and drill_dep else None
+    key = (ws, dataset_version(ws), tuple(sorted(sel_skus)) if sel_skus else None, tuple(sorted(sel_deps)) if sel_deps else None, drill, bool(exact_pick))
+    cached = metrics_cache.get(key)
+    if cached is not None: return cached
+    result = compute_dashboard_metrics(sel_skus, sel_deps, drill_sku, drill_dep, exact_pick, ws)
+    metrics_cache.put(key, result, sum(df.estimated_size() for df in result[1].values()) + 256)
+    return result
+
+def filter_raw(lf, sel_skus=None, sel_deps=None, drill_sku=None, drill_dep=None):
+    # Filtros sem cast sobre o store: Depósito poda partições, SKU usa as estatísticas dos row groups
+    if sel_skus: lf = lf.filter(pl.col("SKU").is_in(sel_skus))
+    if sel_deps: lf = lf.filter(pl.col("Depósito").is_in(sel_deps))
+    if drill_sku and drill_dep: lf = lf.filter((pl.col("SKU") == drill_sku) & (pl.col("Depósito") == drill_dep))
+    return lf
+
+def compute_dashboard_metrics(sel_skus, sel_deps, drill_sku=None, drill_dep=None, exact_pick=False, ws=TEMP_DIR):
+    # KPIs e séries por dia/semana/mês saem do cubo; Pedidos distintos vêm do sketch HLL (ou dos dados brutos, se exato).
+    # Cubo e sketches filtram por código inteiro; os dados brutos (contagem exata) filtram pelo rótulo
+    with measure("consulta dashboard", ws, exato=bool(exact_pick)) as rec:
+        def apply_id_filters(lf):
+            if sel_skus: lf = lf.filter(pl.col("SKU_ID").is_in(lookup_ids("SKU", sel_skus, ws)))
+            if sel_deps: lf = lf.filter(pl.col("Dep_ID").is_in(lookup_ids("Depósito", sel_deps, ws)))
+            if drill_sku and drill_dep:
+                lf = lf.filter(pl.col("SKU_ID").is_in(lookup_ids("SKU", [drill_sku], ws)) & pl.col("Dep_ID").is_in(lookup_ids("Depósito", [drill_dep], ws)))
+            return lf
+
+        rec["plano"] = apply_id_filters(scan_cube(ws))
+        rec["bytes_lidos"] = path_size(os.path.join(ws, CUBE_FILE))
+        cube = rec["plano"].collect()
+        lines, vol, skus, deps, days = cube.select([
+            pl.col("Linhas").sum(),
+            pl.col("Qtd_Dia").sum(),
+            pl.col("SKU_ID").n_unique(),
+            pl.col("Dep_ID").n_unique(),
+            pl.col("Data").n_unique()
+        ]).row(0) if not cube.is_empty() else (0, 0.0, 0, 0, 0)
+        if cube.is_empty(): pick = 0
+        elif exact_pick or not os.path.exists(os.path.join(ws, HLL_FILE)):
+            rec["plano"] = filter_raw(scan_store(ws=ws), sel_skus, sel_deps, drill_sku, drill_dep).select(pl.col("Pedido").n_unique())
+            rec["bytes_lidos"] += store_bytes(ws=ws)
+            pick = rec["plano"].collect().item()
+        else:
+            rec["bytes_lidos"] += path_size(os.path.join(ws, HLL_FILE))
+            pick = hll_estimate(apply_id_filters(pl.scan_parquet(os.path.join(ws, HLL_FILE))))
+        kpis = (lines, vol, pick, skus, deps, days)
+        rec["linhas"] = cube.height
+
+        daily_agg = cube.filter(pl.col("Data").is_not_null()).group_by("Data").agg(pl.col("Qtd_Dia").sum().alias("Quantidade")).sort("Data")
+        return kpis, time_series(daily_agg, ws)
+
+def export_dataset(path, fmt, sel_skus=None, sel_deps=None, drill_sku=None, drill_dep=None, ws=TEMP_DIR):
+    # Scan lazy direto para o arquivo (engine streaming): os dados nunca ficam inteiros em memória
+    with measure("exportação", ws, formato=fmt) as rec:
+        lf = filter_raw(scan_store(ws=ws), sel_skus, sel_deps, drill_sku, drill_dep)
+        _, compression = EXPORT_FORMATS[fmt]
+        rec["plano"], rec["bytes_lidos"] = lf, store_bytes(ws=ws)
+        if compression == "parquet": lf.sink_parquet(path, row_group_size=ROW_GROUP_ROWS)
+        else: lf.sink_csv(path, compression=compression, check_extension=False)
+        rec["bytes_gravados"] = path_size(path)
+        return path
+
+def export_excel(df, path):
+    # constant_memory: o xlsxwriter grava linha a linha no disco. Acima de 1.048.576 linhas a tabela
+    # continua em novas abas; passando de EXCEL_MAX_SHEETS retorna False para o chamador usar CSV.
+    per_sheet = EXCEL_MAX_ROWS - 1
+    sheets = max(1, math.ceil(df.height / per_sheet))
+    if sheets > EXCEL_MAX_SHEETS: return False
+    import xlsxwriter
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True, "nan_inf_to_errors": True})
+    bold = wb.add_format({"bold": True})
+    for i in range(sheets):
+        sh = wb.add_worksheet("Análise" if i == 0 else f"Análise ({i + 1})")
+        sh.write_row(0, 0, df.columns, bold)
+        r = 1
+        for batch in df.slice(i * per_sheet, per_sheet).iter_slices(EXCEL_BATCH_ROWS):
+            for row in batch.iter_rows():
+                sh.write_row(r, 0, row)
+                r += 1
+    wb.close()
+    return True
+
+# ==============================================================================
+# LINHA DE COMANDO (PRÉ-PROCESSAMENTO SEM UI)
+# ==============================================================================
+def load_config(path):
+    # Mesmo conteúdo salvo pela Etapa 2 do app, mais as dimensões opcionais:
+    # {"mapping": {"SKU": "Cod Produto", ...}, "split_dt": true, "dt_source": "Data Hora",
+    #  "abas": "*", "dimensoes": {"SKU": {"arquivo": "skus.xlsx", "chave": "Codigo", "descricao": "Nome"}}}
+    with open(path, encoding="utf-8") as fh: cfg = json.load(fh)
+    if not isinstance(cfg.get("mapping"), dict): raise ValueError("Configuração sem 'mapping'")
+    cfg.setdefault("split_dt", bool(cfg.get("dt_source")))
+    cfg.setdefault("dt_source", None)
+    cfg.setdefault("dimensoes", {})
+    cfg.setdefault("abas", None)  # Excel: null = primeira aba, "*" = todas com as colunas mapeadas, ou lista de nomes
+    return cfg
+
+def run_batch(cfg, files, ws, append=False, log=print):
+    # Ingestão + agregados + tabela de estatísticas; retorna (estatísticas, erros por arquivo)
+    if not append: reset_workspace(ws)
+    os.makedirs(ws, exist_ok=True)
+    run_id = new_run_id()
+    with ExitStack() as stack:
+        handles = [stack.enter_context(open(f, "rb")) for f in files]
+        errors = ingest_files(handles, cfg["mapping"], cfg["split_dt"], cfg["dt_source"], run_id,
+                              on_progress=lambda done, total, name: log(f"[{done}/{total}] {name}"), ws=ws, sheets=cfg.get("abas"))
+    if len(errors) == len(files): return None, errors
+
+    update_aggregates(run_id, ws)
+    with open(os.path.join(ws, CONFIG_FILE), "w", encoding="utf-8") as fh: json.dump(cfg, fh, ensure_ascii=False, indent=2)
+    for kind, dim in cfg["dimensoes"].items():
+        with open(dim["arquivo"], "rb") as fh: save_dimension(fh, dim["chave"], dim["descricao"], kind, ws)
+    stats = calculate_stats_table(ws=ws)
+    if stats is not None: _write(stats, os.path.join(ws, STATS_FILE))
+    return stats, errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pré-processa arquivos de movimentação sem abrir o app.")
+    parser.add_argument("--config", required=True, help="JSON com mapping, split_dt, dt_source e dimensoes")
+    parser.add_argument("--entrada", required=True, help="pasta com os arquivos .csv/.xlsx de movimentação")
+    parser.add_argument("--workspace", help=f"pasta de saída (padrão: {PROJECTS_DIR}/<nome da pasta de entrada>)")
+    parser.add_argument("--acrescentar", action="store_true", help="soma os arquivos ao workspace existente em vez de recriá-lo")
+    parser.add_argument("--exportar-estatisticas", help="grava também a tabela de estatísticas em .xlsx, .csv ou .parquet")
+    parser.add_argument("--log-desempenho", help="grava um registro JSON por etapa (tempo, linhas, bytes, pico de RSS) neste arquivo")
+    args = parser.parse_args(argv)
+    if args.log_desempenho: enable_perf_log(args.log_desempenho)
+
+    cfg = load_config(args.config)
+    files = sorted(f for ext in ("csv", "xlsx") for f in glob.glob(os.path.join(args.entrada, f"*.{ext}")))
+    if not files: parser.error(f"nenhum .csv/.xlsx em {args.entrada}")
+    ws = args.workspace or os.path.join(PROJECTS_DIR, os.path.basename(os.path.abspath(args.entrada)))
+    try: check_workspace(ws)
+    except ValueError as e: parser.error(str(e))
+    init_env()
+
+    t0 = time.time()
+    try: stats, errors = run_batch(cfg, files, ws, append=args.acrescentar)
+    except ValueError as e: parser.error(str(e))
+    for name, msg in errors: print(f"ERRO {name}: {msg}", file=sys.stderr)
+    if stats is None:
+        print("Nenhum arquivo pôde ser processado.", file=sys.stderr)
+        return 1
+
+    out = args.exportar_estatisticas
+    if out:
+        if out.endswith(".xlsx"):
+            if not export_excel(stats, out): print(f"Estatísticas excedem {EXCEL_MAX_SHEETS} abas do Excel; use .csv ou .parquet.", file=sys.stderr)
+        elif out.endswith(".parquet"): stats.write_parquet(out)
+        else: stats.write_csv(out)
+    print(f"{len(files) - len(errors)}/{len(files)} arquivos · {stats.height} pares Depósito/SKU · {time.time() - t0:.1f}s → {ws}")
+    return 0 if not errors else 2
+
+if __name__ == "__main__":
+    sys.exit(main())